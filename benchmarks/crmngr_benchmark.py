@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+
+"""crmngr benchmark suite
+
+Generates a local control repository of configurable size (N branches times
+M modules, mixed git/forge modules, multi-line mod blocks), serves the git
+modules from local file:// repositories and the forge api from a local
+stand-in http server and times the major crmngr phases.
+
+Results are written as JSON, f.e.:
+
+    python benchmarks/crmngr_benchmark.py --branches 200 --modules 100 \\
+        --output benchmark.json
+"""
+
+# stdlib
+import argparse
+from argparse import Namespace
+from contextlib import contextmanager
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+from tempfile import TemporaryDirectory
+import threading
+import time
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+
+# run against the crmngr source tree this benchmark is part of
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# crmngr
+from crmngr.controlrepository import ControlRepository  # noqa: E402
+from crmngr.controlrepository import ModuleIndex  # noqa: E402
+from crmngr.forgeapi import ForgeApi  # noqa: E402
+from crmngr.git import Repository  # noqa: E402
+from crmngr.version import __version__  # noqa: E402
+
+COMMITTER = 'crmngr benchmark <benchmark@crmngr.invalid> 1500000000 +0000'
+FORGE_RELEASES = ['1.0.0', '1.1.0', '1.2.0', '1.10.0']
+GIT_TAGS = ['1.0.0', '1.2.0', '1.10.0']
+
+
+def fast_import(git_dir, commands):
+    """feed a list of git fast-import commands into a bare repository"""
+    stream = b''
+    for command in commands:
+        if isinstance(command, bytes):
+            stream += b'data %d\n%s\n' % (len(command), command)
+        else:
+            stream += command.encode('utf-8') + b'\n'
+    subprocess.run(['git', 'fast-import', '--quiet'], input=stream,
+                   cwd=str(git_dir), check=True)
+
+
+def init_bare(git_dir):
+    """create a bare repository"""
+    subprocess.run(['git', 'init', '--quiet', '--bare', str(git_dir)],
+                   check=True)
+    return git_dir
+
+
+def create_module_repository(git_dir, name):
+    """create a git module repository with a few tags"""
+    init_bare(git_dir)
+    commands = []
+    for mark, tag in enumerate(GIT_TAGS, start=1):
+        commands += [
+            'commit refs/heads/master',
+            'mark :%d' % mark,
+            'committer %s' % COMMITTER,
+            'Release {} of {}'.format(tag, name).encode('utf-8'),
+        ]
+        if mark > 1:
+            commands.append('from :%d' % (mark - 1))
+        commands += [
+            'M 644 inline metadata.json',
+            json.dumps({'name': name, 'version': tag}).encode('utf-8'),
+            '',
+        ]
+    for mark, tag in enumerate(GIT_TAGS, start=1):
+        commands += ['reset refs/tags/%s' % tag, 'from :%d' % mark, '']
+    fast_import(git_dir, commands)
+    return 'file://%s' % git_dir
+
+
+def puppetfile(branch, module_urls):
+    """returns the Puppetfile content of a control repository branch"""
+    lines = ["forge 'http://forge.puppetlabs.com'", '']
+    for index, (module, url) in enumerate(sorted(module_urls.items())):
+        if url is None:
+            version = FORGE_RELEASES[(branch + index) % len(FORGE_RELEASES)]
+            lines.append("mod 'benchmark/%s', '%s'" % (module, version))
+        else:
+            tag = GIT_TAGS[(branch + index) % len(GIT_TAGS)]
+            lines += [
+                '# %s from git' % module,
+                "mod '%s'," % module,
+                "  :git => '%s'," % url,
+                "  :tag => '%s'" % tag,
+            ]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def create_control_repository(git_dir, branches, module_urls):
+    """create a control repository with a branch per environment"""
+    init_bare(git_dir)
+    commands = []
+    for branch in range(branches):
+        commands += [
+            'commit refs/heads/environment%04d' % branch,
+            'committer %s' % COMMITTER,
+            b'Initialize environment.',
+            'M 644 inline Puppetfile',
+            puppetfile(branch, module_urls),
+            'M 644 inline manifests/site.pp',
+            b"hiera_include('classes')",
+            '',
+        ]
+    fast_import(git_dir, commands)
+    return 'file://%s' % git_dir
+
+
+class ForgeHandler(BaseHTTPRequestHandler):
+    """stand-in for the puppet forge v3 modules api"""
+
+    protocol_version = 'HTTP/1.1'
+
+    @staticmethod
+    def module_info(slug):
+        """returns api representation of a module"""
+        return {
+            'slug': slug,
+            'current_release': {
+                'version': FORGE_RELEASES[-1],
+                'updated_at': '2018-01-18 12:00:00 +0000',
+            },
+            'releases': [{'version': version}
+                         for version in reversed(FORGE_RELEASES)],
+        }
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """handle api request"""
+        url = urlparse(self.path)
+        if url.path == '/v3/modules':
+            slugs = parse_qs(url.query).get('slugs', [''])[0].split(',')
+            response = {
+                'pagination': {'next': None},
+                'results': [self.module_info(slug) for slug in slugs if slug],
+            }
+        else:
+            response = self.module_info(url.path.rsplit('/', 1)[-1])
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """do not log requests"""
+
+
+@contextmanager
+def forge_server():
+    """run the forge stand-in and point crmngr at it"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ForgeHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    ForgeApi.configure(url='http://127.0.0.1:%d' % server.server_port)
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class Timings:
+    """collects wall times of benchmark phases"""
+
+    def __init__(self):
+        self.runs = {}
+
+    @contextmanager
+    def measure(self, phase):
+        """measure a single run of phase"""
+        start = time.perf_counter()
+        yield
+        self.runs.setdefault(phase, []).append(time.perf_counter() - start)
+
+    def summary(self):
+        """returns timing statistics per phase"""
+        return {
+            phase: {
+                'min': min(runs),
+                'median': statistics.median(runs),
+                'max': max(runs),
+                'runs': runs,
+            }
+            for phase, runs in self.runs.items()
+        }
+
+
+def update_args(module):
+    """returns cli arguments for a non-interactive atomic forge update"""
+    return Namespace(
+        add=False, atomic=True, diffonly=False, forge=True,
+        forge_version='LATEST_FORGE_VERSION', git_branch=None,
+        git_commit=None, git_tag=None, git_url=None, modules=[module],
+        noninteractive=True, reference=None, remove=False,
+    )
+
+
+def measure_import(timings, repeat):
+    """time `import crmngr` in a fresh interpreter.
+
+    The startup time of the interpreter itself is recorded as
+    import_baseline.
+    """
+    source_dir = str(Path(__file__).resolve().parents[1])
+    for _ in range(repeat):
+        for phase, statement in (('import_baseline', 'pass'),
+                                 ('import', 'import crmngr')):
+            with timings.measure(phase):
+                subprocess.run([sys.executable, '-c', statement],
+                               cwd=source_dir, check=True)
+
+
+def run_benchmark(*, branches, modules, git_ratio, repeat, jobs):
+    """generate the repositories and time all phases"""
+    timings = Timings()
+    measure_import(timings, repeat)
+    with TemporaryDirectory(prefix='crmngr_benchmark_') as tmpdir, \
+            forge_server(), open(os.devnull, 'w') as devnull:
+        tmpdir = Path(tmpdir)
+        git_modules = int(modules * git_ratio)
+        module_urls = {}
+        for index in range(modules):
+            name = 'module%03d' % index
+            if index < git_modules:
+                module_urls[name] = create_module_repository(
+                    tmpdir / 'modules' / name, name
+                )
+            else:
+                module_urls[name] = None
+        url = create_control_repository(tmpdir / 'control', branches,
+                                        module_urls)
+        mirror_dir = str(tmpdir / 'mirror')
+
+        for _ in range(repeat):
+            with timings.measure('clone'):
+                Repository(url)
+            with timings.measure('clone_mirror'):
+                Repository(url, mirror_dir=mirror_dir)
+
+            with timings.measure('init'):
+                control_repo = ControlRepository(url)
+            with timings.measure('collect_puppetfiles'):
+                puppetfiles = control_repo._collect_puppetfiles()
+            control_repo._environments = []
+            control_repo._index = ModuleIndex()
+            with timings.measure('parse_puppetfiles'):
+                control_repo._parse_puppetfiles(puppetfiles)
+            with timings.measure('modules'):
+                control_repo.modules  # pylint: disable=pointless-statement
+            with redirect_stdout(devnull):
+                with timings.measure('report'):
+                    control_repo.report(jobs=jobs, compare=False)
+                with timings.measure('report_compare'):
+                    control_repo.report(jobs=jobs, compare=True,
+                                        version_check=False)
+            with redirect_stdout(devnull), \
+                    timings.measure('update_puppetfiles'):
+                control_repo.update_puppetfiles(
+                    cli_args=update_args('benchmark/module%03d' % (
+                        modules - 1
+                    ))
+                )
+            # reset control repository for the next run
+            create_control_repository(tmpdir / 'control.new', branches,
+                                      module_urls)
+            shutil.rmtree(str(tmpdir / 'control'))
+            (tmpdir / 'control.new').rename(tmpdir / 'control')
+
+    return timings.summary()
+
+
+def main():
+    """benchmark entrypoint"""
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('--branches', type=int, default=50,
+                        help='number of environment branches')
+    parser.add_argument('--modules', type=int, default=30,
+                        help='number of modules per Puppetfile')
+    parser.add_argument('--git-ratio', type=float, default=0.5,
+                        help='share of git modules (rest are forge modules)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs per phase')
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='number of parallel workers for version lookups')
+    parser.add_argument('--output', default='-',
+                        help='file to write the JSON results to (- = stdout)')
+    parser.add_argument('--max-import-time', type=float, metavar='SECONDS',
+                        help=('fail if the median time of `import crmngr` '
+                              'exceeds the interpreter startup time by more '
+                              'than SECONDS'))
+    args = parser.parse_args()
+
+    # commits created by the update phase need an identity
+    for variable in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+        os.environ.setdefault(variable, 'crmngr benchmark')
+    for variable in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+        os.environ.setdefault(variable, 'benchmark@crmngr.invalid')
+
+    results = {
+        'crmngr_version': __version__,
+        'python_version': platform.python_version(),
+        'git_version': subprocess.check_output(
+            ['git', '--version'], universal_newlines=True
+        ).strip(),
+        'parameters': {
+            'branches': args.branches,
+            'modules': args.modules,
+            'git_ratio': args.git_ratio,
+            'repeat': args.repeat,
+            'jobs': args.jobs,
+        },
+        'timings': run_benchmark(
+            branches=args.branches,
+            modules=args.modules,
+            git_ratio=args.git_ratio,
+            repeat=args.repeat,
+            jobs=args.jobs,
+        ),
+    }
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.max_import_time is not None:
+        import_time = (results['timings']['import']['median'] -
+                       results['timings']['import_baseline']['median'])
+        if import_time > args.max_import_time:
+            sys.exit('import crmngr took %.3fs, more than %.3fs' % (
+                import_time, args.max_import_time
+            ))
+
+
+if __name__ == '__main__':
+    main()
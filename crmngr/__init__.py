@@ -3,20 +3,38 @@
 # stdlib
 from configparser import NoSectionError
 import logging
+import signal
 import sys
 
 # 3rd-party
 from crmngr import cprint
-from crmngr.cache import JsonCache
+from crmngr import timings
 from crmngr.cli import parse_cli_args
 from crmngr.config import CrmngrConfig
 from crmngr.config import setup_logging
-from crmngr.controlrepository import ControlRepository
-from crmngr.controlrepository import NoEnvironmentError
-from crmngr.utils import query_yes_no
+from crmngr.exceptions import NoEnvironmentError
+
+# the control repository, git, forge and daemon modules (and their
+# dependencies) are imported by the commands using them, lightweight commands
+# do not pay for importing them.
+# pylint: disable=import-outside-toplevel
 
 LOG = logging.getLogger(__name__)
 
+# commands a running crmngr daemon can answer
+DAEMON_COMMANDS = ['environments', 'report']
+
+# commands not running git
+GIT_FREE_COMMANDS = ['clean', 'profiles']
+
+
+def __getattr__(name):
+    """import ControlRepository on first access"""
+    if name == 'ControlRepository':
+        from crmngr.controlrepository import ControlRepository
+        return ControlRepository
+    raise AttributeError('module %s has no attribute %s' % (__name__, name))
+
 
 def main():
     """main entrypoint"""
@@ -37,10 +55,9 @@ def main():
             sys.exit()
 
     cli_args = parse_cli_args(configuration)
-    # now that the profile is known, reload the configuration using the
-    # correct profile
+    # now that the profile is known, switch to the correct profile
     try:
-        configuration = CrmngrConfig(profile=cli_args.profile)
+        configuration.switch_profile(cli_args.profile)
     except NoSectionError:
         cprint.red('No configuration for profile {profile}'.format(
             profile=cli_args.profile
@@ -48,8 +65,47 @@ def main():
         sys.exit(1)
 
     setup_logging(cli_args.debug)
+    if cli_args.profile_timings or cli_args.profile_timings_json:
+        timings.TIMINGS.enable()
 
-    version_cache = JsonCache(configuration.cache_dir, ttl=cli_args.cache_ttl)
+    if cli_args.daemon and cli_args.command in DAEMON_COMMANDS:
+        from crmngr import daemon
+        exit_code = daemon.query(configuration.socket_path, cli_args.command,
+                                 vars(cli_args))
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from crmngr.cache import CACHE_BACKENDS
+    from crmngr.forgeapi import ForgeApi
+    from crmngr.git import check_git_version
+    from crmngr.git import EXECUTOR
+    from crmngr.git import GitError
+    try:
+        version_cache = CACHE_BACKENDS[configuration.cache_backend](
+            configuration.cache_dir, ttl=cli_args.cache_ttl,
+            max_stale=max(0, configuration.cache_max_stale),
+        )
+    except KeyError:
+        cprint.red('Unsupported cache_backend {backend}. Valid backends: '
+                   '{backends}'.format(
+                       backend=configuration.cache_backend,
+                       backends=', '.join(sorted(CACHE_BACKENDS)),
+                   ))
+        sys.exit(1)
+    ForgeApi.configure(
+        pool_size=cli_args.jobs,
+        retries=configuration.forge_retries,
+        timeout=configuration.forge_timeout,
+    )
+    EXECUTOR.configure(
+        limit_per_host=max(1, configuration.git_connections_per_host),
+    )
+    if cli_args.command not in GIT_FREE_COMMANDS:
+        try:
+            check_git_version()
+        except GitError as exc:
+            cprint.red(str(exc))
+            sys.exit(1)
 
     commands = {
         'clean': command_clean,
@@ -58,6 +114,7 @@ def main():
         'environments': command_environments,
         'profiles': command_profiles,
         'report': command_report,
+        'serve': command_serve,
         'update': command_update,
     }
     try:
@@ -65,20 +122,27 @@ def main():
             configuration=configuration,
             cli_args=cli_args,
             version_cache=version_cache)
-    except NoEnvironmentError:
-        cprint.yellow_bold('no environment is affected by your command. typo?')
     except KeyboardInterrupt:
         cprint.red_bold('crmngr has been aborted.')
+    except NoEnvironmentError:
+        cprint.yellow_bold('no environment is affected by your command. typo?')
+    finally:
+        cprint.flush()
+        if cli_args.profile_timings:
+            timings.TIMINGS.write_table(sys.stderr)
+        if cli_args.profile_timings_json:
+            with open(cli_args.profile_timings_json, 'w') as timings_file:
+                timings.TIMINGS.write_json(timings_file)
 
 
 def command_create(*, configuration, cli_args, version_cache,
                    **kwargs):  # pylint: disable=unused-argument
     """run create command"""
-    control_repo = ControlRepository(
-        clone_url=configuration.control_repo_url,
-    )
-    environments = [environment.name
-                    for environment in control_repo.environments]
+    from crmngr.controlrepository import ControlRepository
+    from crmngr.git import remote_branches
+
+    environments = [branch.name for branch in
+                    remote_branches(configuration.control_repo_url)]
 
     if cli_args.environment in environments:
         cprint.red(
@@ -86,7 +150,7 @@ def command_create(*, configuration, cli_args, version_cache,
             'control repository {profile} ({url})'.format(
                 environment=cli_args.environment,
                 profile=cli_args.profile,
-                url=control_repo.url,
+                url=configuration.control_repo_url,
             ))
         sys.exit(1)
     if cli_args.template:
@@ -96,9 +160,20 @@ def command_create(*, configuration, cli_args, version_cache,
                 'control repository {profile} ({url})'.format(
                     template=cli_args.template,
                     profile=cli_args.profile,
-                    url=control_repo.url,
+                    url=configuration.control_repo_url,
                 ))
             sys.exit(1)
+
+    control_repo = ControlRepository(
+        clone_url=configuration.control_repo_url,
+        mirror_dir=configuration.mirror_dir,
+        parse_cache=version_cache,
+        # cloning a template environment requires all files
+        partial=configuration.partial_clone and not cli_args.template,
+        # only the template environment is required
+        environments=[cli_args.template.strip()] if cli_args.template else [],
+    )
+    if cli_args.template:
         control_repo.clone_environment(
             cli_args.template,
             cli_args.environment,
@@ -106,6 +181,7 @@ def command_create(*, configuration, cli_args, version_cache,
         )
         if cli_args.report:
             control_repo.report(
+                jobs=cli_args.jobs,
                 version_cache=version_cache,
                 version_check=cli_args.version_check,
                 wrap=cli_args.wrap,
@@ -118,11 +194,17 @@ def command_create(*, configuration, cli_args, version_cache,
         cprint.green('Created new empty environment %s' % cli_args.environment)
 
 
-def command_delete(*, configuration, cli_args,
+def command_delete(*, configuration, cli_args, version_cache,
                    **kwargs):  # pylint: disable=unused-argument
     """run delete command"""
+    from crmngr.controlrepository import ControlRepository
+    from crmngr.utils import query_yes_no
+
     control_repo = ControlRepository(
         clone_url=configuration.control_repo_url,
+        mirror_dir=configuration.mirror_dir,
+        parse_cache=version_cache,
+        partial=configuration.partial_clone,
         environments=[cli_args.environment, ]
     )
     environment = sorted(control_repo.environments)[0]
@@ -135,12 +217,24 @@ def command_delete(*, configuration, cli_args,
 def command_report(*, configuration, cli_args, version_cache,
                    **kwargs):  # pylint: disable=unused-argument
     """run report command"""
+    from crmngr.controlrepository import ControlRepository
+
+    if cli_args.environments == []:
+        # -e without any pattern
+        raise NoEnvironmentError
     control_repo = ControlRepository(
         clone_url=configuration.control_repo_url,
+        mirror_dir=configuration.mirror_dir,
+        parse_cache=version_cache,
+        partial=configuration.partial_clone,
         environments=cli_args.environments,
         modules=cli_args.modules,
     )
+    _report(control_repo, cli_args=cli_args, version_cache=version_cache)
 
+
+def _report(control_repo, *, cli_args, version_cache):
+    """print report of control_repo"""
     if cli_args.compare and not len(control_repo.environments) >= 2:
         cprint.yellow_bold(
             'At least two environments required in compare mode. Only matched '
@@ -153,27 +247,104 @@ def command_report(*, configuration, cli_args, version_cache,
 
     control_repo.report(
         compare=cli_args.compare,
+        jobs=cli_args.jobs,
+        output_format=cli_args.output_format,
         version_cache=version_cache,
         version_check=cli_args.version_check,
         wrap=cli_args.wrap,
     )
 
 
-def command_environments(*, configuration,
+def command_environments(*, configuration, cli_args,
                          **kwargs):  # pylint: disable=unused-argument
     """run environments command"""
-    control_repo = ControlRepository(
-        clone_url=configuration.control_repo_url,
+    from crmngr.git import remote_branches
+
+    _print_environments(
+        remote_branches(configuration.control_repo_url,
+                        details=cli_args.long),
+        profile=configuration.profile,
+        long=cli_args.long,
     )
-    cprint.white_bold('Environments in profile %s' % configuration.profile)
-    for environment in sorted(control_repo.environments):
-        cprint.white(' - {}'.format(environment.name))
 
 
-def command_update(*, configuration, cli_args,
+def _print_environments(branches, *, profile, long):
+    """print list of environments"""
+    cprint.white_bold('Environments in profile %s' % profile)
+    for branch in branches:
+        if long:
+            cprint.white(' - {name} ({date:%Y-%m-%d %H:%M}, {author})'.format(
+                name=branch.name, date=branch.date, author=branch.author,
+            ))
+        else:
+            cprint.white(' - {}'.format(branch.name))
+
+
+def command_serve(*, configuration, cli_args, version_cache,
+                  **kwargs):  # pylint: disable=unused-argument
+    """run serve command"""
+    from crmngr import daemon
+    from crmngr.controlrepository import ControlRepository
+
+    if cli_args.refresh:
+        if daemon.query(configuration.socket_path, 'refresh') is None:
+            cprint.red('No crmngr daemon running for profile %s' %
+                       configuration.profile)
+            sys.exit(1)
+        return
+
+    def load():
+        """returns a freshly parsed control repository"""
+        return ControlRepository(
+            clone_url=configuration.control_repo_url,
+            mirror_dir=configuration.mirror_dir,
+            parse_cache=version_cache,
+            partial=configuration.partial_clone,
+        )
+
+    def report(control_repo, args):
+        """answer report command"""
+        try:
+            selection = control_repo.select(args.environments, args.modules)
+        except NoEnvironmentError:
+            cprint.yellow_bold(
+                'no environment is affected by your command. typo?'
+            )
+            return
+        _report(selection, cli_args=args, version_cache=version_cache)
+
+    def environments(control_repo, args):
+        """answer environments command"""
+        _print_environments(control_repo.branch_details(),
+                            profile=configuration.profile, long=args.long)
+
+    crmngr_daemon = daemon.Daemon(
+        socket_path=configuration.socket_path,
+        load=load,
+        handlers={
+            'environments': environments,
+            'report': report,
+        },
+        interval=cli_args.interval,
+    )
+    # leave serve_forever through SystemExit to remove the socket on SIGTERM
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        crmngr_daemon.serve()
+    except daemon.DaemonError as exc:
+        cprint.red(str(exc))
+        sys.exit(1)
+
+
+def command_update(*, configuration, cli_args, version_cache,
                    **kwargs):  # pylint: disable=unused-argument
     """run report command"""
+    from crmngr.controlrepository import ControlRepository
+    from crmngr.git import MirrorStore
 
+    if cli_args.environments == []:
+        # -e without any pattern
+        raise NoEnvironmentError
     if cli_args.reference:
         environments = cli_args.environments + [cli_args.reference]
     else:
@@ -181,7 +352,14 @@ def command_update(*, configuration, cli_args,
 
     control_repo = ControlRepository(
         clone_url=configuration.control_repo_url,
+        mirror_dir=configuration.mirror_dir,
+        parse_cache=version_cache,
+        partial=configuration.partial_clone,
         environments=environments,
+        module_mirrors=MirrorStore(
+            configuration.module_mirror_dir,
+            max_size=configuration.module_mirror_size,
+        ) if configuration.module_mirror_dir else None,
     )
     control_repo.update_puppetfiles(
         cli_args=cli_args,
@@ -191,6 +369,8 @@ def command_update(*, configuration, cli_args,
 def command_clean(*, version_cache,
                   **kwargs):  # pylint: disable=unused-argument
     """run clean command"""
+    from crmngr.utils import query_yes_no
+
     if query_yes_no("Really clear cache directory?"):
         return version_cache.clear()
 
@@ -4,8 +4,13 @@ import json
 import logging
 import os
 import shutil
+import sqlite3
+import threading
 import time
 
+# crmngr
+from crmngr import timings
+
 LOG = logging.getLogger(__name__)
 
 
@@ -15,50 +20,76 @@ class CacheError(Exception):
 
 
 class JsonCache:
-    """json file based cache"""
+    """json file based cache
+
+    Entries expired for at most max_stale seconds are returned with an
+    additional stale key (stale-while-revalidate).
+    """
 
-    def __init__(self, directory, ttl=86400, fail_silently=True):
+    def __init__(self, directory, ttl=86400, fail_silently=True,
+                 max_stale=0):
         """constructor, takes directory as argument"""
         LOG.debug("initialize JsonCache in %s", directory)
         self._directory = directory
         self._default_ttl = ttl
         self._fail_silently = fail_silently
+        self._max_stale = max_stale
 
     def clear(self):
         """delete cache directory"""
         shutil.rmtree(self._directory)
         LOG.debug("deleted cache directory %s", self._directory)
 
-    def read(self, key, ttl=None):
-        """read json dict from file"""
+    def read(self, key, ttl=None, category='cache'):
+        """read json dict from file.
+
+        category is the timings category the lookup is recorded in.
+        """
         if ttl is None:
             ttl = self._default_ttl
         try:
             LOG.debug("attempt to read %s from cache", key)
-            with open(os.path.join(self._directory, key)) as cache_fd:
+            with timings.measure(category, 'read'), \
+                    open(os.path.join(self._directory, key)) as cache_fd:
                 cache = json.load(cache_fd)
                 LOG.debug("received %s from cache", cache)
             if cache.get('updated', 0) + ttl >= int(time.time()):
                 LOG.debug("cache entry is valid, return it")
+                timings.count(category, 'hit')
                 return cache
+            if cache['updated'] + ttl + self._max_stale >= int(time.time()):
+                LOG.debug("cache entry is stale, return it for revalidation")
+                timings.count(category, 'stale')
+                return dict(cache, stale=True)
             LOG.debug("cache expired, returning empty response")
+            timings.count(category, 'expired')
             return {}
         except (AttributeError, KeyError, OSError, ValueError) as exc:
             LOG.debug(
                 "cache lookup for %s failed. fail silently.", key
             )
+            timings.count(category, 'miss')
             if self._fail_silently:
                 return {}
             else:
                 raise CacheError('could not read from cache') from exc
 
-    def write(self, key, jsondict):
+    def read_many(self, keys, ttl=None, category='cache'):
+        """read json dicts for multiple keys.
+
+        returns a dict with the key as key and the json dict as value.
+        """
+        return {key: self.read(key, ttl=ttl, category=category)
+                for key in keys}
+
+    def write(self, key, jsondict, category='cache'):
         """write json dict to file"""
         try:
             LOG.debug(
                 "attempt to write %s to cache using key %s", jsondict, key
             )
-            with open(os.path.join(self._directory, key), 'w') as cache_fd:
+            with timings.measure(category, 'write'), \
+                    open(os.path.join(self._directory, key), 'w') as cache_fd:
                 localdict = jsondict.copy()
                 localdict.update(
                     {
@@ -71,3 +102,195 @@ class JsonCache:
             if not self._fail_silently:
                 raise CacheError('could not write to cache') from exc
             LOG.debug('failed to write to cache. fail silently.')
+
+    def write_many(self, items, category='cache'):
+        """write multiple json dicts. items is a dict of key: jsondict"""
+        for key, jsondict in items.items():
+            self.write(key, jsondict, category=category)
+
+    def expire(self, ttl=None, prefix=''):
+        """delete all entries (with keys starting with prefix) older than
+        ttl. returns number of entries."""
+        if ttl is None:
+            ttl = self._default_ttl
+        deadline = int(time.time()) - ttl
+        deleted = 0
+        try:
+            keys = os.listdir(self._directory)
+        except OSError:
+            return deleted
+        for key in keys:
+            if not key.startswith(prefix):
+                continue
+            path = os.path.join(self._directory, key)
+            try:
+                # entries are written at once, mtime is their update time
+                if os.path.isfile(path) and os.stat(path).st_mtime < deadline:
+                    os.remove(path)
+                    deleted += 1
+            except OSError:
+                continue
+        LOG.debug("expired %s entries from cache", deleted)
+        return deleted
+
+
+class SqliteCache:
+    """sqlite database based cache
+
+    All entries are stored in a single database file in directory, indexed by
+    key and update time. Entries expired for at most max_stale seconds are
+    returned with an additional stale key (stale-while-revalidate).
+    """
+
+    DATABASE = 'cache.sqlite'
+
+    def __init__(self, directory, ttl=86400, fail_silently=True,
+                 max_stale=0):
+        """constructor, takes directory as argument"""
+        LOG.debug("initialize SqliteCache in %s", directory)
+        self._directory = directory
+        self._default_ttl = ttl
+        self._fail_silently = fail_silently
+        self._max_stale = max_stale
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """returns database connection, initializes database if required"""
+        if self._connection is None:
+            os.makedirs(self._directory, exist_ok=True)
+            self._connection = sqlite3.connect(
+                os.path.join(self._directory, self.DATABASE),
+                check_same_thread=False,
+            )
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            with self._connection:
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache ('
+                    'key TEXT PRIMARY KEY, '
+                    'value TEXT NOT NULL, '
+                    'updated INTEGER NOT NULL)'
+                )
+                self._connection.execute(
+                    'CREATE INDEX IF NOT EXISTS cache_updated '
+                    'ON cache (updated)'
+                )
+        return self._connection
+
+    def clear(self):
+        """delete cache directory"""
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+            shutil.rmtree(self._directory)
+        LOG.debug("deleted cache directory %s", self._directory)
+
+    def read(self, key, ttl=None, category='cache'):
+        """read json dict from database"""
+        return self.read_many([key, ], ttl=ttl, category=category)[key]
+
+    def read_many(self, keys, ttl=None, category='cache'):
+        """read json dicts for multiple keys.
+
+        returns a dict with the key as key and the json dict as value.
+        category is the timings category the lookups are recorded in.
+        """
+        if ttl is None:
+            ttl = self._default_ttl
+        keys = list(keys)
+        result = {key: {} for key in keys}
+        expired = int(time.time()) - ttl
+        try:
+            LOG.debug("attempt to read %s keys from cache", len(keys))
+            with self._lock, timings.measure(category, 'read'):
+                connection = self._connect()
+                # stay below sqlite's limit of host parameters per statement
+                for offset in range(0, len(keys), 500):
+                    batch = keys[offset:offset + 500]
+                    rows = connection.execute(
+                        'SELECT key, value, updated FROM cache '
+                        'WHERE updated >= ? AND key IN (%s)' % ', '.join(
+                            '?' * len(batch)
+                        ),
+                        [expired - self._max_stale] + batch,
+                    ).fetchall()
+                    for key, value, updated in rows:
+                        cache = json.loads(value)
+                        cache['updated'] = updated
+                        if updated < expired:
+                            cache['stale'] = True
+                        result[key] = cache
+            for key in keys:
+                if result[key].get('stale'):
+                    timings.count(category, 'stale')
+                else:
+                    timings.count(category, 'hit' if result[key] else 'miss')
+            LOG.debug("received %s valid entries from cache",
+                      len([key for key in keys if result[key]]))
+        except (AttributeError, OverflowError, sqlite3.Error, OSError,
+                ValueError) as exc:
+            LOG.debug("cache lookup failed. fail silently.")
+            if not self._fail_silently:
+                raise CacheError('could not read from cache') from exc
+        return result
+
+    def write(self, key, jsondict, category='cache'):
+        """write json dict to database"""
+        self.write_many({key: jsondict}, category=category)
+
+    def write_many(self, items, category='cache'):
+        """write multiple json dicts. items is a dict of key: jsondict"""
+        updated = int(time.time())
+        try:
+            LOG.debug("attempt to write %s entries to cache", len(items))
+            with self._lock, timings.measure(category, 'write'):
+                connection = self._connect()
+                with connection:
+                    connection.executemany(
+                        'INSERT OR REPLACE INTO cache (key, value, updated) '
+                        'VALUES (?, ?, ?)',
+                        [(key, json.dumps(jsondict), updated)
+                         for key, jsondict in items.items()],
+                    )
+            LOG.debug("wrote %s entries to cache", len(items))
+        except (AttributeError, sqlite3.Error, OSError, TypeError,
+                ValueError) as exc:
+            if not self._fail_silently:
+                raise CacheError('could not write to cache') from exc
+            LOG.debug('failed to write to cache. fail silently.')
+
+    def keys(self):
+        """returns a list of all keys in the cache"""
+        with self._lock:
+            return [key for (key, ) in self._connect().execute(
+                'SELECT key FROM cache ORDER BY key'
+            )]
+
+    def expire(self, ttl=None, prefix=''):
+        """delete all entries (with keys starting with prefix) older than
+        ttl. returns number of entries."""
+        if ttl is None:
+            ttl = self._default_ttl
+        deleted = 0
+        try:
+            with self._lock:
+                connection = self._connect()
+                with connection:
+                    deleted = connection.execute(
+                        'DELETE FROM cache WHERE updated < ? '
+                        'AND substr(key, 1, ?) = ?',
+                        (int(time.time()) - ttl, len(prefix), prefix),
+                    ).rowcount
+        except (sqlite3.Error, OSError) as exc:
+            if not self._fail_silently:
+                raise CacheError('could not expire cache') from exc
+            LOG.debug('failed to expire cache. fail silently.')
+        LOG.debug("expired %s entries from cache", deleted)
+        return deleted
+
+
+CACHE_BACKENDS = {
+    'json': JsonCache,
+    'sqlite': SqliteCache,
+}
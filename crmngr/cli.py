@@ -6,6 +6,7 @@ import sys
 import textwrap
 
 # crmngr
+from crmngr.reportwriter import REPORT_WRITERS
 from crmngr.version import __version__
 
 
@@ -32,15 +33,40 @@ def parse_cli_args(configuration):
         dest='debug', action='store_true', default=False,
         help='enable debug output'
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        dest='jobs', type=int, metavar='N',
+        help='number of parallel workers used for version lookups',
+    )
+    parser.add_argument(
+        '--daemon',
+        dest='daemon', action='store_true', default=False,
+        help=('send environments and report commands to a running crmngr '
+              'daemon (see serve command). Results may be up to the '
+              'refresh interval of the daemon old.'),
+    )
     parser.add_argument(
         '-p', '--profile',
         dest='profile', default='default',
         help='crmngr configuration profile'
     )
+    parser.add_argument(
+        '--profile-timings',
+        dest='profile_timings', action='store_true', default=False,
+        help=('record wall time and count of all git commands, forge '
+              'requests, cache lookups and crmngr phases and print a summary '
+              'to stderr at exit.'),
+    )
+    parser.add_argument(
+        '--profile-timings-json',
+        dest='profile_timings_json', metavar='FILE',
+        help='like --profile-timings, but write the summary as JSON to FILE.',
+    )
 
     # set defaults for global options
     parser.set_defaults(
         cache_ttl=configuration.cache_ttl,
+        jobs=configuration.jobs,
     )
 
     # define command parsers
@@ -61,6 +87,7 @@ def parse_cli_args(configuration):
     environments_command_parser(**command_parser_defaults)
     profiles_command_parser(**command_parser_defaults)
     report_command_parser(**command_parser_defaults)
+    serve_command_parser(**command_parser_defaults)
     update_parser = update_command_parser(**command_parser_defaults)
 
     args = parser.parse_args()
@@ -263,6 +290,11 @@ def environments_command_parser(parent_parser,
                      'currently selected profile.'),
         help='list all environments of the selected profile',
     )
+    parser.add_argument(
+        '-l', '--long',
+        action='store_true', dest='long',
+        help='show date and author of the last commit of every environment',
+    )
     return parser
 
 
@@ -322,6 +354,14 @@ def report_command_parser(parent_parser, configuration,
         help=('compare mode will only show modules that differ between '
               'environments.'),
     )
+    display_group.add_argument(
+        '-f', '--format',
+        dest='output_format', choices=['text'] + sorted(REPORT_WRITERS),
+        default='text',
+        help=('output format. jsonl, csv and json write a record for every '
+              'module version, streamed while latest versions are resolved. '
+              '(default: text)'),
+    )
     version_check_group = display_group.add_mutually_exclusive_group()
     version_check_group.add_argument(
         '--version-check',
@@ -362,6 +402,38 @@ def report_command_parser(parent_parser, configuration,
     return parser
 
 
+def serve_command_parser(parent_parser,
+                         **kwargs):  # pylint: disable=unused-argument
+    """sets up the argument parser for the serve command"""
+    parser = parent_parser.add_parser(
+        'serve',
+        description=(
+            'Run crmngr as daemon.\n'
+            '\n'
+            'The daemon keeps the control repository of the selected profile '
+            'parsed in memory and answers environments and report commands '
+            'sent over a unix socket (~/.crmngr/serve-PROFILE.sock). '
+            'environments and report commands only use a running daemon '
+            'if --daemon is specified. The control repository is fetched '
+            'again every --interval seconds, answers may be up to this old.'
+        ),
+        formatter_class=KeepNewlineDescriptionHelpFormatter,
+        help='run crmngr as daemon answering report queries',
+    )
+    parser.add_argument(
+        '-i', '--interval',
+        type=int, dest='interval', default=300, metavar='SECONDS',
+        help='seconds between refreshes of the control repository '
+             '(default: 300)',
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true', dest='refresh',
+        help='make a running daemon refresh its control repository and exit',
+    )
+    return parser
+
+
 def update_command_parser(parent_parser,
                           **kwargs):  # pylint: disable=unused-argument
     """sets up the argument parser for the report command"""
@@ -426,6 +498,13 @@ def update_command_parser(parent_parser,
               'If combined with --remove, modules not in reference will be '
               'removed from the environments (-e).')
     )
+    update_options.add_argument(
+        '--atomic',
+        default=False, action='store_true',
+        help=('commit Puppetfiles without checking out the environments and '
+              'push all environments in a single atomic push. Either all or '
+              'no environment is updated.')
+    )
     interactivity_group = parser.add_argument_group('interactivity options')
     interactivity_mutex = interactivity_group.add_mutually_exclusive_group()
     interactivity_mutex.add_argument(
@@ -4,7 +4,6 @@
 from collections import namedtuple
 from configparser import ConfigParser
 import logging
-import logging.config
 import os
 
 LOG = logging.getLogger(__name__)
@@ -13,6 +12,8 @@ LOG = logging.getLogger(__name__)
 def setup_logging(debug):
     """setup logging configuration"""
     if debug:
+        # pylint: disable=import-outside-toplevel
+        import logging.config
         logging.config.dictConfig({
             'version': 1,
             'disable_existing_loggers': False,
@@ -49,7 +50,16 @@ class CrmngrConfig:
         # initialize preferences
         self._config = ConfigParser(
             defaults={
+                'cache_backend': 'json',
+                'cache_max_stale': '0',
                 'cache_ttl': '86400',
+                'forge_retries': '3',
+                'forge_timeout': '30',
+                'git_connections_per_host': '4',
+                'jobs': '8',
+                'mirror': 'no',
+                'module_mirror_size': '1024',
+                'partial_clone': 'no',
                 'version_check': 'yes',
                 'wrap': 'yes'
             }
@@ -63,6 +73,12 @@ class CrmngrConfig:
         self._profiles.read(os.path.join(self._config_dir, 'profiles'))
         self._control_repo_url = self._profiles.get(self.profile, 'repository')
 
+    def switch_profile(self, profile):
+        """switch to another profile without reading the configuration files
+        again"""
+        self._control_repo_url = self._profiles.get(profile, 'repository')
+        self._profile = profile
+
     @classmethod
     def create_default_configuration(cls, default_profile_url):
         """ensure a default profile is configured."""
@@ -78,15 +94,51 @@ class CrmngrConfig:
     @property
     def cache_dir(self):
         """returns the cache directory"""
-        self._cache_dir = os.path.join(self._config_dir, 'cache')
-        os.makedirs(self._cache_dir, exist_ok=True)
+        if self._cache_dir is None:
+            self._cache_dir = os.path.join(self._config_dir, 'cache')
+            os.makedirs(self._cache_dir, exist_ok=True)
         return self._cache_dir
 
+    @property
+    def mirror_dir(self):
+        """returns the control repository mirror directory of the active
+        profile or None if mirroring is disabled"""
+        if not self._config.getboolean('crmngr', 'mirror'):
+            return None
+        return os.path.join(self._config_dir, 'mirrors', self.profile)
+
+    @property
+    def module_mirror_dir(self):
+        """returns the directory of the module repository mirrors or None if
+        module mirroring is disabled"""
+        if (not self._config.getboolean('crmngr', 'mirror') or
+                not self.module_mirror_size):
+            return None
+        return os.path.join(self._config_dir, 'module-mirrors')
+
+    @property
+    def module_mirror_size(self):
+        """returns the maximum total size of all module repository mirrors
+        in bytes"""
+        return self._config.getint('crmngr', 'module_mirror_size') * 1024 ** 2
+
     @property
     def control_repo_url(self):
         """returns control repo url"""
         return self._control_repo_url
 
+    @property
+    def partial_clone(self):
+        """returns whether or not to clone the control repository without
+        blobs"""
+        return self._config.getboolean('crmngr', 'partial_clone')
+
+    @property
+    def socket_path(self):
+        """returns the path of the unix socket of the crmngr daemon of the
+        active profile"""
+        return os.path.join(self._config_dir, 'serve-%s.sock' % self.profile)
+
     @property
     def profile(self):
         """returns active configuration profile"""
@@ -126,11 +178,41 @@ class CrmngrConfig:
         """returns version_check config setting as bool"""
         return self._config.getboolean('crmngr', 'version_check')
 
+    @property
+    def cache_max_stale(self):
+        """returns cache_max_stale config setting as int"""
+        return self._config.getint('crmngr', 'cache_max_stale')
+
     @property
     def cache_ttl(self):
         """returns cache_ttl config setting as int"""
         return self._config.getint('crmngr', 'cache_ttl')
 
+    @property
+    def cache_backend(self):
+        """returns cache_backend config setting"""
+        return self._config.get('crmngr', 'cache_backend')
+
+    @property
+    def forge_retries(self):
+        """returns forge_retries config setting as int"""
+        return self._config.getint('crmngr', 'forge_retries')
+
+    @property
+    def forge_timeout(self):
+        """returns forge_timeout config setting as float"""
+        return self._config.getfloat('crmngr', 'forge_timeout')
+
+    @property
+    def git_connections_per_host(self):
+        """returns git_connections_per_host config setting as int"""
+        return self._config.getint('crmngr', 'git_connections_per_host')
+
+    @property
+    def jobs(self):
+        """returns jobs config setting as int"""
+        return self._config.getint('crmngr', 'jobs')
+
     @property
     def wrap(self):
         """returns wrap config setting as bool"""
@@ -2,28 +2,37 @@
 
 # stdlib
 from collections import defaultdict
+from collections import deque
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from itertools import chain
 import logging
 import os
 import re
 import sys
-from tempfile import TemporaryDirectory
 from textwrap import TextWrapper
 
 # crmgnr
-from crmngr.cache import JsonCache
+from crmngr.exceptions import NoEnvironmentError
 from crmngr.forgeapi import ForgeApi, ForgeError
 from crmngr.git import Repository
 from crmngr.git import GitError
+from crmngr.git import latest_remote_tags
+from crmngr.git import ls_remote
+from crmngr.git import RemoteRepository
 from crmngr.puppetfile import Forge
 from crmngr.puppetfile import ForgeModule
 from crmngr.puppetfile import GitBranch
 from crmngr.puppetfile import GitCommit
 from crmngr.puppetfile import GitModule
 from crmngr.puppetfile import GitTag
+from crmngr.puppetfile import LatestVersions
 from crmngr.puppetfile import PuppetModule
+from crmngr.puppetfile import SERIALIZATION_VERSION
+from crmngr.reportwriter import REPORT_WRITERS
 from crmngr import cprint
+from crmngr import timings
 from crmngr.utils import fnlistmatch
 from crmngr.utils import query_yes_no
 
@@ -32,18 +41,127 @@ from natsort import natsorted
 
 LOG = logging.getLogger(__name__)
 
+# parsed Puppetfiles not written for this number of seconds are reparsed and
+# removed from the parse cache
+PARSE_CACHE_TTL = 30 * 86400
 
-class NoEnvironmentError(Exception):
-    """exception raised when no environment is matched"""
+
+class ModuleIndex:
+    """index of the modules of all environments of a control repository.
+
+    Maps module names to module versions to the environments they are
+    deployed in. The index is maintained by PuppetEnvironment when modules
+    are added, replaced or removed.
+
+    Every environment is assigned a dense integer id. The environments of a
+    module version are stored as bitmask of these ids, environment names are
+    only materialized on access.
+    """
+
+    def __init__(self):
+        """initialize empty index"""
+        self._modules = {}
+        self._environments = defaultdict(set)
+        self._ids = {}
+        self._names = []
+
+    def __contains__(self, module):
+        return module in self._modules
+
+    def __getitem__(self, module):
+        """returns a dict with versions as keys and a set of environment
+        names as values"""
+        return {
+            version: set(self.names(mask))
+            for version, mask in self.masks(module).items()
+        }
+
+    def __iter__(self):
+        return iter(self._modules)
+
+    def __len__(self):
+        return len(self._modules)
+
+    def _bit(self, environment):
+        """returns the bitmask of a single environment"""
+        try:
+            return 1 << self._ids[environment]
+        except KeyError:
+            self._ids[environment] = len(self._names)
+            self._names.append(environment)
+            return 1 << self._ids[environment]
+
+    def add(self, environment, module, version):
+        """add a module version deployed in environment"""
+        versions = self._modules.setdefault(module, {})
+        versions[version] = versions.get(version, 0) | self._bit(environment)
+        self._environments[environment].add(module)
+
+    def remove(self, environment, module, version):
+        """remove a module version deployed in environment"""
+        versions = self._modules[module]
+        versions[version] &= ~self._bit(environment)
+        if not versions[version]:
+            del versions[version]
+        if not versions:
+            del self._modules[module]
+        self._environments[environment].discard(module)
+
+    def items(self):
+        """returns an iterator of (module, versions) tuples"""
+        return ((module, self[module]) for module in self._modules)
+
+    def masks(self, module):
+        """returns a dict with versions as keys and the bitmask of the
+        environments they are deployed in as values"""
+        return self._modules.get(module, {})
+
+    def mask(self, environments):
+        """returns the bitmask of environments"""
+        mask = 0
+        for environment in environments:
+            mask |= self._bit(environment)
+        return mask
+
+    def names(self, mask):
+        """returns the environment names of a bitmask"""
+        names = []
+        while mask:
+            lowest = mask & -mask
+            names.append(self._names[lowest.bit_length() - 1])
+            mask ^= lowest
+        return names
+
+    def environments(self, module):
+        """returns the names of all environments a module is deployed in"""
+        mask = 0
+        for version_mask in self.masks(module).values():
+            mask |= version_mask
+        return set(self.names(mask))
+
+    def modules(self, environment):
+        """returns the names of all modules deployed in an environment"""
+        return self._environments.get(environment, set())
+
+    def versions(self, module):
+        """returns all deployed versions of a module"""
+        return list(self.masks(module))
 
 
 class PuppetEnvironment:
     """r10k puppet environment"""
 
-    def __init__(self, name, modules=None):
-        """initialize puppet environment"""
+    def __init__(self, name, modules=None, *, index=None):
+        """initialize puppet environment.
+
+        If index is specified, all modules of the environment are added to
+        this ModuleIndex and it is kept up to date on every modification.
+        """
         self._name = name
-        self._modules = modules or OrderedDict()
+        self._index = index
+        self._modules = OrderedDict()
+        for key, module in (modules or {}).items():
+            self[key] = module
         LOG.debug('initialize PuppetEnvironment(%s)', self._name)
 
     def __repr__(self):
@@ -53,16 +171,22 @@ class PuppetEnvironment:
         return iter(self._modules.items())
 
     def __delitem__(self, key):
+        if self._index is not None:
+            self._index.remove(self.name, key, self._modules[key])
         del self._modules[key]
 
     def __getitem__(self, item):
         return self._modules[item]
 
     def __setitem__(self, key, value):
+        if self._index is not None:
+            if key in self._modules:
+                self._index.remove(self.name, key, self._modules[key])
+            self._index.add(self.name, key, value)
         self._modules[key] = value
         LOG.debug('added %s(%s) for PuppetEnvironment(%s)',
                   key,
-                  vars(value),
+                  value,
                   self.name)
 
     def __lt__(self, other):
@@ -88,15 +212,83 @@ class PuppetEnvironment:
 class ControlRepository(Repository):
     """r10k-style control repository"""
 
-    def __init__(self, clone_url, environments=None, modules=None):
-        """clone control repository and parse the puppetfiles it contains."""
-        super().__init__(clone_url)
+    def __init__(self, clone_url, environments=None, modules=None, *,
+                 mirror_dir=None, parse_cache=None, partial=False,
+                 module_mirrors=None):
+        """clone control repository and parse the puppetfiles it contains.
+
+        parse_cache is an optional cache (f.e. JsonCache) used to store parsed
+        Puppetfiles across runs.
+
+        If environments are specified, the matching branches are resolved
+        with a remote ref listing first and only these are fetched.
+        NoEnvironmentError is raised if no branch matches. If environments is
+        an empty list, no environment is fetched at all (f.e. to create a new
+        environment).
+
+        If partial is True, the control repository is fetched as partial clone
+        and only the Puppetfiles are fetched on demand.
+
+        module_mirrors is an optional MirrorStore. If specified, versions of
+        git modules are validated against persistent module mirrors instead
+        of fresh clones.
+        """
+        with timings.measure('phase', 'clone'):
+            branches = None
+            if environments is not None:
+                branches = self._match_environments(
+                    sorted(
+                        reference[len('refs/heads/'):]
+                        for reference in ls_remote(clone_url, heads=True)
+                    ),
+                    environments,
+                )
+                if environments and not branches:
+                    raise NoEnvironmentError
+            super().__init__(clone_url, mirror_dir=mirror_dir,
+                             branches=branches, partial=partial)
 
+        self._parse_cache = parse_cache
+        self._module_mirrors = module_mirrors
+        self._pending_pushes = []
         self._environments = []
-        self._parse_puppetfiles(
-            puppetfiles=self._collect_puppetfiles(environments),
+        self._index = ModuleIndex()
+        self._puppetfiles = {}
+        if environments is not None and not environments:
+            return
+        with timings.measure('phase', 'collect'):
+            self._puppetfiles = self._collect_puppetfiles(environments)
+        with timings.measure('phase', 'parse'):
+            self._parse_puppetfiles(
+                puppetfiles=self._puppetfiles,
+                puppetmodules=modules,
+            )
+
+    def select(self, environments=None, modules=None):
+        """returns a copy limited to environments and modules matching the
+        patterns.
+
+        The copy shares the working copy and is parsed from the Puppetfiles
+        collected on initialization without running any git command.
+        """
+        puppetfiles = self._puppetfiles
+        if environments is not None:
+            puppetfiles = {
+                branch: puppetfiles[branch]
+                for branch in self._match_environments(sorted(puppetfiles),
+                                                       environments)
+            }
+            if not puppetfiles:
+                raise NoEnvironmentError
+        selection = copy(self)
+        selection._environments = []
+        selection._index = ModuleIndex()
+        selection._pending_pushes = []
+        selection._parse_puppetfiles(
+            puppetfiles=puppetfiles,
             puppetmodules=modules,
         )
+        return selection
 
     @property
     def environments(self):
@@ -123,6 +315,7 @@ class ControlRepository(Repository):
         if report:
             # reread control repository with only new environment
             self._environments = []
+            self._index = ModuleIndex()
             self._parse_puppetfiles(
                 self._collect_puppetfiles([new_env, ])
             )
@@ -149,47 +342,102 @@ class ControlRepository(Repository):
         if report:
             # reread control repository with only new environment
             self._environments = []
+            self._index = ModuleIndex()
             self._parse_puppetfiles(
                 self._collect_puppetfiles([new_env, ])
             )
 
+    @staticmethod
+    def _match_environments(branches, environments):
+        """returns the branches matching the environment patterns.
+
+        If the first element of environments is !, the remaining patterns
+        are exclude patterns, otherwise they are include patterns.
+        """
+        if not environments:
+            return []
+        matching = []
+        for branch in branches:
+            if environments[0] == '!':
+                if fnlistmatch(branch, patterns=environments[1:]):
+                    LOG.debug(
+                        ('branch %s does match an exclude pattern '
+                         '%s. Skipping.'),
+                        branch,
+                        environments[1:]
+                    )
+                    continue
+            else:
+                if not fnlistmatch(branch, patterns=environments):
+                    LOG.debug(
+                        ('branch %s does not match any include pattern '
+                         '%s. Skipping.'),
+                        branch,
+                        environments
+                    )
+                    continue
+            matching.append(branch)
+        return matching
+
     def _collect_puppetfiles(self, environments=None):
         """collect Puppetfile from all control repository branches.
 
         This will return a dictionary with environments as keys and a list of
-        every Puppetfile mod line as value.
+        every module in the Puppetfile (in serialized form) as value.
 
-        Mulitiline mod lines are collapsed, empty and comment lines ignored.
+        Puppetfiles are read straight from the git objects of the remote
+        branches, the working copy is never touched. If a parse cache is
+        configured, only Puppetfiles that have not been parsed before (by
+        blob sha1) are read and parsed.
         """
 
-        puppetfiles = {}
+        branches = list(self.branches)
+        if environments is not None:
+            branches = self._match_environments(branches, environments)
 
-        for branch in self.branches:
-            if environments is not None:
-                if environments[0] == '!':
-                    if fnlistmatch(branch, patterns=environments[1:]):
-                        LOG.debug(
-                            ('branch %s does match an exclude pattern '
-                             '%s. Skipping.'),
-                            branch,
-                            environments[1:]
-                        )
-                        continue
-                else:
-                    if not fnlistmatch(branch, patterns=environments):
-                        LOG.debug(
-                            ('branch %s does not match any include pattern '
-                             '%s. Skipping.'),
-                            branch,
-                            environments
-                        )
-                        continue
+        objects = OrderedDict(
+            ('refs/remotes/origin/%s:Puppetfile' % branch, branch)
+            for branch in branches
+        )
+        blobs = self.object_names(objects)
+        # keyed by content and format of the parse result
+        cache_keys = {
+            sha: 'puppetfile-v%s-%s' % (SERIALIZATION_VERSION, sha)
+            for sha in set(blobs.values())
+        }
+
+        parsed = {}
+        if self._parse_cache is not None:
+            cached = self._parse_cache.read_many(cache_keys.values(),
+                                                 ttl=PARSE_CACHE_TTL,
+                                                 category='parse')
+            for sha, key in cache_keys.items():
+                if 'modules' in cached[key]:
+                    parsed[sha] = cached[key]['modules']
+        missing = [sha for sha in cache_keys if sha not in parsed]
+        LOG.debug('%s of %s Puppetfiles loaded from parse cache',
+                  len(parsed), len(cache_keys))
 
-            self.git(['checkout', branch])
-            with open(os.path.join(self._workdir, 'Puppetfile')) as puppetfile:
-                puppetfiles[branch] = self._collapse_puppetfile(
-                    puppetfile.readlines()
+        for sha, puppetfile in self.cat_files(missing):
+            parsed[sha] = [
+                PuppetModule.from_moduleline(moduleline).serialize()
+                for moduleline in self._collapse_puppetfile(
+                    (puppetfile or '').splitlines()
                 )
+            ]
+        if self._parse_cache is not None and missing:
+            self._parse_cache.write_many({
+                cache_keys[sha]: {'modules': parsed[sha]} for sha in missing
+            }, category='parse')
+            # remove parse results of old Puppetfiles (and formats)
+            self._parse_cache.expire(ttl=PARSE_CACHE_TTL,
+                                     prefix='puppetfile-')
+
+        puppetfiles = {}
+        for name, branch in objects.items():
+            if name not in blobs:
+                LOG.debug('branch %s does not contain a Puppetfile', branch)
+            puppetfiles[branch] = parsed.get(blobs.get(name), [])
 
         if puppetfiles:
             return puppetfiles
@@ -229,17 +477,16 @@ class ControlRepository(Repository):
 
     def _parse_puppetfiles(self, puppetfiles, puppetmodules=None):
         """extract module information from puppetfiles"""
-        for environment, modulelines in puppetfiles.items():
+        for environment, modules in puppetfiles.items():
             puppetenvironment = PuppetEnvironment(
-                environment
+                environment,
+                index=self._index,
             )
-            for moduleline in modulelines:
+            for module in modules:
                 LOG.debug('processing module %s in environment %s',
-                          moduleline,
+                          module,
                           environment)
-                module_object = PuppetModule.from_moduleline(
-                    moduleline
-                )
+                module_object = PuppetModule.deserialize(module)
                 if puppetmodules is not None:
                     if puppetmodules[0] == '!':
                         if fnlistmatch(module_object.name,
@@ -265,10 +512,10 @@ class ControlRepository(Repository):
             self._environments.append(puppetenvironment)
 
     @staticmethod
-    def _bulk_update(environment, *, modules, cache):
+    def _bulk_update(environment, *, modules, latest_versions):
         """updates modules in environment to latest version."""
         cprint.white_bold('Bulk update environment {}'.format(environment.name))
-        for _, module in environment:
+        for _, module in list(environment):
             if modules is not None:
                 if modules[0] == '!':
                     if fnlistmatch(module.name, patterns=modules[1:]):
@@ -284,13 +531,16 @@ class ControlRepository(Repository):
                 cprint.white('Get latest version for module {}'.format(
                     module.name
                 ))
-                module.version = module.get_latest_version(cache)
+                cprint.flush()
+                environment[module.name] = module.with_version(
+                    latest_versions.get(module)
+                )
             except TypeError:
                 LOG.debug('Could not determine latest module version for '
                           'module %s. Setting to None.', module.name)
                 cprint.yellow_bold('Could not determine latest module version '
                                    'for module {}!'.format(module.name))
-                module.version = None
+                environment[module.name] = module.with_version(None)
         return environment
 
     @staticmethod
@@ -322,8 +572,10 @@ class ControlRepository(Repository):
         if add and remove:
             # if we set both add and remove, we basically replace
             # the environment with the template
-            environment = PuppetEnvironment(environment.name,
-                                            reference.modules)
+            for module in list(environment.modules):
+                del environment[module]
+            for module, module_object in reference:
+                environment[module] = module_object
             LOG.debug('replaced environment %s with %s',
                       environment.name,
                       reference.name)
@@ -355,10 +607,12 @@ class ControlRepository(Repository):
         ))
         forge_api = ForgeApi(name=module.name, author=module.author)
         if version is None:
-            module.version = None
+            module = module.with_version(None)
         elif version == 'LATEST_FORGE_VERSION':
             try:
-                module.version = Forge(forge_api.current_version['version'])
+                module = module.with_version(
+                    Forge(forge_api.current_version['version'])
+                )
             except ForgeError as exc:
                 cprint.red(
                     'Could not determine latest version of forge '
@@ -392,7 +646,7 @@ class ControlRepository(Repository):
                     )
                 )
                 sys.exit(1)
-            module.version = Forge(version)
+            module = module.with_version(Forge(version))
         return module
 
     def _update_git_module(self, module_string, *, url, branch, commit, tag):
@@ -433,8 +687,9 @@ class ControlRepository(Repository):
                            ))
                 sys.exit(1)
             url = list(git_urls)[0]
+        module = GitModule(module_name, url=url)
         try:
-            module_repository = Repository(url)
+            module_repository = RemoteRepository(url)
         except GitError as exc:
             cprint.red(
                 '{url} is not a valid git repository: {error}'.format(
@@ -443,12 +698,10 @@ class ControlRepository(Repository):
                 )
             )
             sys.exit(1)
-        module = GitModule(module_name, url=url)
         if branch is not None:
             try:
-                module_repository.git(['fetch', '--unshallow'])
                 module_repository.validate_branch(branch)
-                module.version = GitBranch(branch)  # pylint: disable=R0204
+                module = module.with_version(GitBranch(branch))
             except GitError as exc:
                 cprint.red('Could not verify branch {branch} for {module}: '
                            '{error}'.format(
@@ -459,9 +712,14 @@ class ControlRepository(Repository):
                 sys.exit(1)
         elif commit is not None:
             try:
-                module_repository.git(['fetch', '--unshallow'])
-                module_repository.validate_commit(commit)
-                module.version = GitCommit(commit)  # pylint: disable=R0204
+                try:
+                    module_repository.validate_commit(commit)
+                except GitError as exc:
+                    LOG.debug('could not verify commit %s without history: '
+                              '%s', commit, exc)
+                    with self._module_history(module) as history:
+                        history.validate_commit(commit)
+                module = module.with_version(GitCommit(commit))
             except GitError as exc:
                 cprint.red('Could not verify commit {commit} for {module}: '
                            '{error}'.format(
@@ -473,8 +731,8 @@ class ControlRepository(Repository):
         elif tag is not None:
             if tag == 'LATEST_GIT_TAG':
                 try:
-                    module.version = GitTag(  # pylint: disable=R0204
-                        module_repository.latest_tag.name
+                    module = module.with_version(
+                        GitTag(module_repository.latest_tag.name)
                     )
                 except GitError as exc:
                     cprint.red('Could not determine latest tag for git module '
@@ -485,9 +743,8 @@ class ControlRepository(Repository):
                     sys.exit(1)
             else:
                 try:
-                    module_repository.git(['fetch', 'origin', '--tags'])
                     module_repository.validate_tag(tag)
-                    module.version = GitTag(tag)  # pylint: disable=R0204
+                    module = module.with_version(GitTag(tag))
                 except GitError as exc:
                     cprint.red('Could not verify tag {tag} for {module}: '
                                '{error}'.format(
@@ -498,75 +755,110 @@ class ControlRepository(Repository):
                     sys.exit(1)
         return module
 
+    def _module_history(self, module):
+        """returns a Repository with the full history of a git module.
+
+        The persistent module mirror is used if module mirrors are enabled,
+        otherwise the module is cloned.
+        """
+        if self._module_mirrors is not None:
+            return self._module_mirrors.repository(module.cachename,
+                                                   module.url)
+        repository = Repository(module.url)
+        repository.git(['fetch', '--unshallow'])
+        return repository
+
     def update_puppetfiles(self, *, cli_args):
         """update puppetfiles"""
-        with TemporaryDirectory(prefix='crmngr_update_cache') as cache_dir:
-            reference = None
-            module = None
+        reference = None
+        module = None
 
-            update_cache = JsonCache(cache_dir)
-            if cli_args.reference:
-                try:
-                    reference = self.get_environment(cli_args.reference)
-                except StopIteration:
-                    cprint.red('%s specified as reference environment does not '
-                               'exist' % cli_args.reference)
-                    sys.exit(1)
-            elif cli_args.git_url and not cli_args.remove:
-                module = self._update_git_module(  # pylint: disable=R0204
-                    module_string=cli_args.modules[0],
-                    url=cli_args.git_url,
-                    branch=cli_args.git_branch,
-                    commit=cli_args.git_commit,
-                    tag=cli_args.git_tag,
+        # latest versions are looked up once per module for all environments
+        latest_versions = LatestVersions()
+        if cli_args.reference:
+            try:
+                reference = self.get_environment(cli_args.reference)
+            except StopIteration:
+                cprint.red('%s specified as reference environment does not '
+                           'exist' % cli_args.reference)
+                sys.exit(1)
+        elif cli_args.git_url and not cli_args.remove:
+            module = self._update_git_module(  # pylint: disable=R0204
+                module_string=cli_args.modules[0],
+                url=cli_args.git_url,
+                branch=cli_args.git_branch,
+                commit=cli_args.git_commit,
+                tag=cli_args.git_tag,
+            )
+        elif cli_args.forge and not cli_args.remove:
+            module = self._update_forge_module(  # pylint: disable=R0204
+                module_string=cli_args.modules[0],
+                version=cli_args.forge_version,
+            )
+        for environment in sorted(self._environments):
+            # reference update mode
+            commit_message = 'Update Environment'
+            if reference:
+                if environment == reference:
+                    # when having a reference environment, it will be in the
+                    # control repository. So we skip it.
+                    continue
+                environment = self._reference_update(
+                    environment,
+                    reference=reference,
+                    add=cli_args.add,
+                    remove=cli_args.remove,
                 )
-            elif cli_args.forge and not cli_args.remove:
-                module = self._update_forge_module(  # pylint: disable=R0204
-                    module_string=cli_args.modules[0],
-                    version=cli_args.forge_version,
+                commit_message = 'Update {} based on {}.'.format(
+                    environment.name,
+                    reference.name,
                 )
-            for environment in sorted(self._environments):
-                # reference update mode
-                commit_message = 'Update Environment'
-                if reference:
-                    if environment == reference:
-                        # when having a reference environment, it will be in the
-                        # control repository. So we skip it.
-                        continue
-                    environment = self._reference_update(
-                        environment,
-                        reference=reference,
-                        add=cli_args.add,
-                        remove=cli_args.remove,
-                    )
-                    commit_message = 'Update {} based on {}.'.format(
-                        environment.name,
-                        reference.name,
-                    )
-                elif module is not None:
-                    if cli_args.add or module.name in environment.modules:
-                        environment[module.name] = module
-                        commit_message = module.update_commit_message
-                elif cli_args.remove:
-                    environment = self._bulk_remove(
-                        environment,
-                        modules=cli_args.modules,
+            elif module is not None:
+                if cli_args.add or module.name in environment.modules:
+                    environment[module.name] = module
+                    commit_message = module.update_commit_message
+            elif cli_args.remove:
+                environment = self._bulk_remove(
+                    environment,
+                    modules=cli_args.modules,
+                )
+                commit_message = 'Bulk update {}.'.format(environment.name)
+            # bulk update mode (i.e. no version / update options specified)
+            else:
+                environment = self._bulk_update(
+                    environment,
+                    modules=cli_args.modules,
+                    latest_versions=latest_versions,
+                )
+                commit_message = 'Bulk update {}.'.format(environment.name)
+            with timings.measure('phase', 'write'):
+                if cli_args.atomic:
+                    self.commit_puppetfile(
+                        commit_message=commit_message,
+                        diff_only=cli_args.diffonly,
+                        environment=environment,
+                        non_interactive=cli_args.noninteractive,
                     )
-                    commit_message = 'Bulk update {}.'.format(environment.name)
-                # bulk update mode (i.e. no version / update options specified)
                 else:
-                    environment = self._bulk_update(
-                        environment,
-                        modules=cli_args.modules,
-                        cache=update_cache,
+                    self.write_puppetfile(
+                        commit_message=commit_message,
+                        diff_only=cli_args.diffonly,
+                        environment=environment,
+                        non_interactive=cli_args.noninteractive,
                     )
-                    commit_message = 'Bulk update {}.'.format(environment.name)
-                self.write_puppetfile(
-                    commit_message=commit_message,
-                    diff_only=cli_args.diffonly,
-                    environment=environment,
-                    non_interactive=cli_args.noninteractive,
-                )
+        if cli_args.atomic:
+            with timings.measure('phase', 'push'):
+                self.push_puppetfiles()
+        cprint.flush()
+
+    @staticmethod
+    def _render_puppetfile(environment):
+        """returns the content of the Puppetfile of a PuppetEnvironment"""
+        # file header and module lines
+        return "forge 'http://forge.puppetlabs.com'\n\n" + ''.join(
+            '{}\n'.format(line)
+            for line in chain.from_iterable(environment.puppetfile)
+        )
 
     def write_puppetfile(self, environment, *,
                          commit_message='Update Puppetfile', diff_only=False,
@@ -577,13 +869,7 @@ class ControlRepository(Repository):
                   'w') as puppetfile:
             LOG.debug('write new version of Puppetfile in environment %s',
                       environment.name)
-            # write file header
-            puppetfile.write("forge 'http://forge.puppetlabs.com'\n\n")
-            # write module lines
-            puppetfile.writelines(
-                ('{}\n'.format(line)
-                 for line in chain.from_iterable(environment.puppetfile))
-            )
+            puppetfile.write(self._render_puppetfile(environment))
         # ask git for a diff
         diff = self.git(['diff'])
         if diff:
@@ -604,7 +890,8 @@ class ControlRepository(Repository):
                         ['commit', '-m', commit_message, 'Puppetfile']
                     )
                     try:
-                        self.git(['push', 'origin', environment.name])
+                        with timings.measure('phase', 'push'):
+                            self.git(['push', 'origin', environment.name])
                         cprint.green('Updated environment {}'.format(
                             environment.name
                         ))
@@ -624,73 +911,371 @@ class ControlRepository(Repository):
         else:
             LOG.debug('Puppetfile for environment %s unchanged', environment.name)
 
+    def commit_puppetfile(self, environment, *,
+                          commit_message='Update Puppetfile', diff_only=False,
+                          non_interactive=False):
+        """commit a PuppetEnvironment to a Puppetfile without checkout.
+
+        The commit is created using a temporary index and the environment is
+        queued to be pushed by push_puppetfiles.
+        """
+        branch = 'refs/remotes/origin/%s' % environment.name
+        new_blob = self.git(['hash-object', '-w', '--stdin'],
+                            input=self._render_puppetfile(environment)).strip()
+        old_blob = self.object_names(['%s:Puppetfile' % branch]).get(
+            '%s:Puppetfile' % branch
+        )
+        if old_blob is None:
+            old_blob = self.git(['hash-object', '-w', '--stdin'],
+                                input='').strip()
+        if old_blob == new_blob:
+            LOG.debug('Puppetfile for environment %s unchanged',
+                      environment.name)
+            return
+
+        if not non_interactive:
+            cprint.white_bold('Diff for environment %s:' % environment.name)
+            cprint.diff(self.git(['diff', old_blob, new_blob]))
+        if diff_only or not (non_interactive or query_yes_no(
+                'Update (commit and push) Puppetfile for '
+                'environment {}'.format(environment.name))):
+            return
+
+        index = dict(os.environ, GIT_INDEX_FILE=os.path.join(
+            self._tmpdir.name, 'index'
+        ))
+        try:
+            self.git(['read-tree', branch], env=index)
+            self.git(['update-index', '--add', '--cacheinfo', '100644',
+                      new_blob, 'Puppetfile'], env=index)
+            tree = self.git(['write-tree'], env=index).strip()
+        finally:
+            os.remove(index['GIT_INDEX_FILE'])
+        commit = self.git(['commit-tree', tree, '-p', branch,
+                           '-m', commit_message]).strip()
+        self.git(['update-ref', 'refs/heads/%s' % environment.name, commit])
+        self._pending_pushes.append(environment.name)
+        LOG.debug('committed %s as %s for environment %s', tree, commit,
+                  environment.name)
+
+    def push_puppetfiles(self):
+        """push all environments committed by commit_puppetfile at once.
+
+        The push is atomic, either all environments or no environment is
+        updated.
+        """
+        if not self._pending_pushes:
+            return
+        try:
+            self.git(['push', '--atomic', '--quiet', 'origin'] +
+                     ['refs/heads/{0}:refs/heads/{0}'.format(environment)
+                      for environment in self._pending_pushes])
+        except GitError as exc:
+            cprint.red(
+                'Could not update environments {environments}. No environment '
+                'has been updated. Maybe somebody else pushed changes to one '
+                'of the environments during current crmngr run. Full git '
+                'error: {error}'.format(
+                    environments=', '.join(self._pending_pushes),
+                    error=exc,
+                ))
+            sys.exit(1)
+        for environment in self._pending_pushes:
+            cprint.green('Updated environment {}'.format(environment))
+        self._pending_pushes = []
+
     @property
     def modules(self):
         """returns modules and module versions.
 
-        This will return a dict containing all modules with their versions and
-        environments they are deployed in.
+        This will return a ModuleIndex containing all modules with their
+        versions and environments they are deployed in.
         """
-        modules = defaultdict(lambda: defaultdict(set))
-        for environment in self._environments:
-            for module, module_object in environment:
-                modules[module][module_object].add(environment.name)
-        return modules
+        return self._index
 
-    def report(self, wrap=True, version_check=True, version_cache=None,
-               compare=True):
-        """print control repository report"""
+    def write_report(self, writer, *, version_check=True, version_cache=None,
+                     compare=True, jobs=8):
+        """write control repository report as machine readable records.
 
-        for module, versions in sorted(self.modules.items()):
+        A record is written for every module version. Latest versions are
+        resolved in chunks, records of a chunk are written while the next
+        chunk is resolved in the background.
+        """
+        cprint.flush()
+        all_environments = self.modules.mask(
+            environment.name for environment in self._environments
+        )
+        shared_versions = LatestVersions(version_cache)
+        for module, versions, latest_versions in self._resolve_chunks(
+                self._report_modules(compare),
+                version_check=version_check,
+                latest_versions=shared_versions,
+                jobs=jobs,
+        ):
+            deployed = 0
+            for mask in versions.values():
+                deployed |= mask
+            missing = sorted(self.modules.names(all_environments & ~deployed))
+            for version, mask in natsorted(versions.items(), reverse=True,
+                                           key=str):
+                source, _, location, version_type, version_name = \
+                    version.serialize()
+                latest_version = latest_versions.get(version.cachename)
+                if latest_version is None or latest_version.version is None:
+                    latest_name = latest_stale = up_to_date = None
+                else:
+                    latest_name = latest_version.version
+                    latest_stale = latest_version.stale
+                    up_to_date = version_name == latest_name
+                writer.write({
+                    'module': module,
+                    'source': source,
+                    'location': location,
+                    'version_type': version_type,
+                    'version': version_name,
+                    'environments': sorted(self.modules.names(mask)),
+                    'missing_from': missing,
+                    'latest_version': latest_name,
+                    'latest_stale': latest_stale,
+                    'up_to_date': up_to_date,
+                })
+        writer.close()
+        self._wait_for_refreshes(shared_versions)
+
+    @staticmethod
+    def _wait_for_refreshes(latest_versions):
+        """wait a bounded time for background refreshes of stale versions."""
+        running = latest_versions.wait(timeout=LatestVersions.REFRESH_TIMEOUT)
+        if running:
+            LOG.warning('%s stale latest versions could not be refreshed '
+                        'within %s seconds', running,
+                        LatestVersions.REFRESH_TIMEOUT)
+
+    def _resolve_chunks(self, modules, *, version_check, latest_versions,
+                        jobs):
+        """yields (module, versions, latest_versions) tuples for modules.
+
+        Latest versions are resolved in chunks of ForgeApi.BATCH_SIZE modules
+        with resolve_latest_versions. The next chunk is resolved while the
+        current one is processed.
+        """
+        def resolve(chunk):
+            """resolve latest versions of a chunk of modules"""
+            if not version_check:
+                return {}
+            with timings.measure('phase', 'resolve'):
+                return self.resolve_latest_versions(
+                    chain.from_iterable(versions for _, versions in chunk),
+                    latest_versions=latest_versions,
+                    jobs=jobs,
+                )
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            for offset in range(0, len(modules), ForgeApi.BATCH_SIZE):
+                chunk = modules[offset:offset + ForgeApi.BATCH_SIZE]
+                pending.append((chunk, executor.submit(resolve, chunk)))
+                if len(pending) < 2:
+                    continue
+                chunk, future = pending.popleft()
+                for module, versions in chunk:
+                    yield module, versions, future.result()
+            for chunk, future in pending:
+                for module, versions in chunk:
+                    yield module, versions, future.result()
+
+    @staticmethod
+    def resolve_latest_versions(puppetmodules, *, version_cache=None, jobs=8,
+                                latest_versions=None):
+        """resolve the latest versions of puppet modules concurrently.
+
+        Every git repository and forge module is only looked up once. Cached
+        versions are read with a single query, stale ones are refreshed in
+        the background. Uncached git repositories are queried concurrently
+        on the git executor, everything else uses a pool of jobs workers.
+        latest_versions is an optional LatestVersions instance shared between
+        multiple calls, which is created with version_cache if not specified.
+        Returns a dict with the cachename of the modules as key and the
+        latest version as value.
+        """
+        if latest_versions is None:
+            latest_versions = LatestVersions(version_cache)
+        version_cache = latest_versions.version_cache
+        unique_modules = OrderedDict()
+        for module in puppetmodules:
+            unique_modules.setdefault(module.cachename, module)
+        # modules not resolved (or in progress) in this run yet
+        pending = OrderedDict(
+            (cachename, module)
+            for cachename, module in unique_modules.items()
+            if cachename not in latest_versions
+        )
+
+        # read all cached versions at once, stale versions are refreshed in
+        # the background
+        if version_cache is not None:
+            cached = version_cache.read_many(
+                cachename for cachename, module in pending.items()
+                if isinstance(module, (ForgeModule, GitModule))
+            )
+            for cachename, local_info in cached.items():
+                if local_info:
+                    module = pending.pop(cachename)
+                    latest_versions.set(module,
+                                        module.version_from_info(local_info))
+
+        # resolve uncached forge modules with as few api requests as possible
+        forge_modules = {
+            module.forgename: module
+            for cachename, module in pending.items()
+            if isinstance(module, ForgeModule)
+        }
+        if forge_modules:
+            LOG.debug('resolve latest version of %s forge modules in bulk',
+                      len(forge_modules))
+            try:
+                forge_versions = ForgeApi.current_versions(forge_modules)
+            except ForgeError as exc:
+                LOG.debug('bulk lookup failed, fall back to single lookups: '
+                          '%s', exc)
+                forge_versions = {}
+            for forgename, local_info in forge_versions.items():
+                module = forge_modules[forgename]
+                if version_cache is not None:
+                    version_cache.write(module.cachename, local_info)
+                latest_versions.set(module,
+                                    module.version_from_info(local_info))
+                del pending[module.cachename]
+
+        # resolve uncached git modules concurrently on the git executor
+        git_modules = {
+            module.url: module
+            for module in pending.values()
+            if isinstance(module, GitModule)
+        }
+        if git_modules:
+            LOG.debug('resolve latest version of %s git modules concurrently',
+                      len(git_modules))
+            for url, latest_tag in latest_remote_tags(git_modules).items():
+                module = git_modules[url]
+                local_info = module.info_from_tag(latest_tag)
+                if version_cache is not None:
+                    version_cache.write(module.cachename, local_info)
+                latest_versions.set(module,
+                                    module.version_from_info(local_info))
+                del pending[module.cachename]
+
+        LOG.debug('resolve latest version of %s modules using %s workers',
+                  len(pending), jobs)
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            for _ in executor.map(latest_versions.get, pending.values()):
+                pass
+        return {
+            cachename: latest_versions.get(module)
+            for cachename, module in unique_modules.items()
+        }
+
+    def _report_modules(self, compare):
+        """returns a list of (module, versions) tuples to report.
+
+        versions is a dict with the versions as keys and the bitmask of the
+        environments they are deployed in as values.
+        """
+        all_environments = self.modules.mask(
+            environment.name for environment in self._environments
+        )
+        modules = []
+        for module in sorted(self.modules):
+            versions = self.modules.masks(module)
 
             # in compare mode, skip modules that are identical in all processed
             # environments.
             if compare and len(versions) == 1 and \
-                            len(list(versions.values())[0]) == len(self._environments):
+                    next(iter(versions.values())) == all_environments:
                 continue
+            modules.append((module, versions))
+        return modules
 
-            cprint.white_bold('Module: %s' % module)
-            for version, environments in natsorted(
-                    versions.items(),
-                    reverse=True,
-                    key=str
-            ):
-                version.print_version_information(
-                    version_check,
-                    version_cache
-                )
-                if len(self._environments) > 1:
-                    cprint.white('Used by:', lpad=4, rpad=4, end='')
-                    if wrap:
-                        used_by = TextWrapper(
-                            subsequent_indent=' ' * 16
-                        )
-                        for line in used_by.wrap(
-                                ' '.join(sorted(environments))
-                        ):
-                            cprint.cyan(line)
-                    else:
-                        cprint.cyan(' '.join(sorted(environments)))
-                print()
-
-            if compare:
-                # check for modules that are in not in all (but in at least one)
-                # processed environments
-                missing = set.union(*list(versions.values())) ^ set(
-                    [environment.name for environment in self._environments]
+    def report(self, wrap=True, version_check=True, version_cache=None,
+               compare=True, jobs=8, output_format='text'):
+        """print control repository report.
+
+        If output_format is not text, the report is written as machine
+        readable records in this format (see REPORT_WRITERS).
+        """
+        if output_format != 'text':
+            self.write_report(
+                REPORT_WRITERS[output_format](sys.stdout),
+                version_check=version_check,
+                version_cache=version_cache,
+                compare=compare,
+                jobs=jobs,
+            )
+            return
+
+        all_environments = self.modules.mask(
+            environment.name for environment in self._environments
+        )
+        modules = self._report_modules(compare)
+
+        # resolve all latest versions upfront, before rendering the report
+        shared_versions = LatestVersions(version_cache)
+        if version_check:
+            with timings.measure('phase', 'resolve'):
+                latest_versions = self.resolve_latest_versions(
+                    chain.from_iterable(versions for _, versions in modules),
+                    version_cache=version_cache,
+                    jobs=jobs,
+                    latest_versions=shared_versions,
                 )
-                if missing:
-                    cprint.yellow_bold('Missing from:', lpad=2)
-                    if wrap:
-                        not_in = TextWrapper(
-                            initial_indent=' ' * 16,
-                            subsequent_indent=' ' * 16
-                        )
-                        for line in not_in.wrap(
-                                ' '.join(sorted(missing))
-                        ):
-                            cprint.yellow(line)
-                    else:
-                        print(' ' * 16, end='')
-                        cprint.yellow(' '.join(sorted(missing)))
-                    print()
+        else:
+            latest_versions = {}
+
+        used_by = TextWrapper(subsequent_indent=' ' * 16)
+        not_in = TextWrapper(initial_indent=' ' * 16,
+                             subsequent_indent=' ' * 16)
+        with timings.measure('phase', 'render'):
+            for module, versions in modules:
+                cprint.white_bold('Module: %s' % module)
+                for version, mask in natsorted(
+                        versions.items(),
+                        reverse=True,
+                        key=str
+                ):
+                    version.print_version_information(
+                        version_check,
+                        version_cache,
+                        latest_version=latest_versions.get(version.cachename),
+                    )
+                    if len(self._environments) > 1:
+                        environments = self.modules.names(mask)
+                        cprint.white('Used by:', lpad=4, rpad=4, end='')
+                        if wrap:
+                            for line in used_by.wrap(
+                                    ' '.join(sorted(environments))
+                            ):
+                                cprint.cyan(line)
+                        else:
+                            cprint.cyan(' '.join(sorted(environments)))
+                    cprint.plain('')
+
+                if compare:
+                    # check for modules that are in not in all (but in at
+                    # least one) processed environments
+                    deployed = 0
+                    for mask in versions.values():
+                        deployed |= mask
+                    missing = self.modules.names(all_environments & ~deployed)
+                    if missing:
+                        cprint.yellow_bold('Missing from:', lpad=2)
+                        if wrap:
+                            for line in not_in.wrap(
+                                    ' '.join(sorted(missing))
+                            ):
+                                cprint.yellow(line)
+                        else:
+                            cprint.plain(' ' * 16, end='')
+                            cprint.yellow(' '.join(sorted(missing)))
+                        cprint.plain('')
+            cprint.flush()
+        self._wait_for_refreshes(shared_versions)
@@ -2,6 +2,12 @@
 
 """function for colored terminal output"""
 
+# stdlib
+import atexit
+import os
+import sys
+import time
+
 TERM_BLUE = '\033[0;34m'
 TERM_BLUE_BOLD = '\033[1;34m'
 TERM_CYAN = '\033[0;36m'
@@ -20,25 +26,84 @@ TERM_YELLOW_BOLD = '\033[1;33m'
 TERM_NONE = '\033[0;m'
 
 
+class Renderer:
+    """buffered writer for colored terminal output.
+
+    Output is accumulated in a buffer and written to stdout in large chunks,
+    at the latest after flush_interval seconds. Colors are only emitted if
+    stdout is a terminal and NO_COLOR is not set.
+    """
+
+    def __init__(self, buffer_size=65536, flush_interval=0.1):
+        """initialize renderer"""
+        self._buffer = []
+        self._buffered = 0
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._flushed = time.monotonic()
+        self._color = False
+        self._stream = None
+
+    def _select_stream(self):
+        """follow replacements of sys.stdout (f.e. by redirect_stdout)"""
+        if sys.stdout is self._stream:
+            return
+        self.flush()
+        self._stream = sys.stdout
+        try:
+            isatty = self._stream.isatty()
+        except (AttributeError, ValueError):
+            isatty = False
+        self._color = isatty and not os.environ.get('NO_COLOR')
+
+    def write(self, color, text, *, prefix='', suffix='', lpad=0, rpad=0,
+              sep='', end='\n'):
+        """add text to the buffer. color is ignored if colors are disabled"""
+        self._select_stream()
+        if self._color and color is not None:
+            pieces = (' '*lpad, prefix, color, text, suffix, ' '*rpad,
+                      TERM_NONE)
+        else:
+            pieces = (' '*lpad, prefix, text, suffix, ' '*rpad)
+        chunk = sep.join(str(piece) for piece in pieces) + end
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self._buffer_size or \
+                time.monotonic() - self._flushed >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """write buffered output to stdout"""
+        if self._buffer and self._stream is not None:
+            try:
+                self._stream.write(''.join(self._buffer))
+                self._stream.flush()
+            except ValueError:
+                # stream has been closed in the meantime
+                pass
+        self._buffer = []
+        self._buffered = 0
+        self._flushed = time.monotonic()
+
+
+RENDERER = Renderer()
+# output buffered when exiting early (f.e. sys.exit) must not be lost
+atexit.register(RENDERER.flush)
+
+
 def _cprint(color, text, **kwargs):
     """helper function to print colored text"""
-    prefix = kwargs.pop('prefix', '')
-    suffix = kwargs.pop('suffix', '')
-    lpad = kwargs.pop('lpad', 0)
-    rpad = kwargs.pop('rpad', 0)
-    sep = kwargs.pop('sep', '')
-
-    print(
-        ' '*lpad,
-        prefix,
-        color,
-        text,
-        suffix,
-        ' '*rpad,
-        TERM_NONE,
-        sep=sep,
-        **kwargs
-    )
+    RENDERER.write(color, text, **kwargs)
+
+
+def flush():
+    """write buffered output"""
+    RENDERER.flush()
+
+
+def plain(text, **kwargs):
+    """print text without color"""
+    _cprint(None, text, **kwargs)
 
 
 def blue(text, **kwargs):
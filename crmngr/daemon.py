@@ -0,0 +1,204 @@
+""" crmngr daemon module """
+
+# stdlib
+from argparse import Namespace
+from contextlib import redirect_stdout
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+
+# crmngr
+from crmngr import cprint
+
+LOG = logging.getLogger(__name__)
+
+
+class DaemonError(Exception):
+    """exception raised when the daemon cannot be started"""
+
+
+class _ResponseStream:
+    """file-like object sending output to a daemon client"""
+
+    def __init__(self, wfile, tty=False):
+        """initialize response stream"""
+        self._wfile = wfile
+        self._tty = tty
+
+    def write(self, text):
+        """send output to the client"""
+        if text:
+            _send(self._wfile, {'output': text})
+        return len(text)
+
+    def flush(self):
+        """flush output to the client"""
+        self._wfile.flush()
+
+    def isatty(self):
+        """returns whether or not the client writes to a terminal"""
+        return self._tty
+
+
+def _send(wfile, message):
+    """send a single message as json line"""
+    wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """handles a single daemon request"""
+
+    def handle(self):
+        """run requested command and stream its output to the client"""
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError as exc:
+            LOG.debug('invalid daemon request: %s', exc)
+            return
+        LOG.debug('daemon request: %s', request)
+        exit_code = self.server.daemon.run(
+            request.get('command'),
+            Namespace(**request.get('args', {})),
+            _ResponseStream(self.wfile, tty=request.get('tty', False)),
+        )
+        _send(self.wfile, {'exit': exit_code})
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    """threading unix socket server"""
+
+    daemon_threads = True
+
+
+class Daemon:
+    """keeps a parsed control repository resident and answers requests.
+
+    load is a callable returning a new ControlRepository. handlers is a dict
+    with command names as keys and callables with the signature
+    handler(control_repository, cli_args) as values. Output of a handler is
+    sent to the client. Requests and refreshes are serialized.
+    """
+
+    def __init__(self, *, socket_path, load, handlers, interval=300):
+        """initialize daemon"""
+        self._socket_path = socket_path
+        self._load = load
+        self._handlers = handlers
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._control_repo = None
+
+    def refresh(self):
+        """reload the control repository"""
+        LOG.debug('refresh control repository')
+        control_repo = self._load()
+        with self._lock:
+            self._control_repo, old_control_repo = (control_repo,
+                                                    self._control_repo)
+        if old_control_repo is not None:
+            old_control_repo.cleanup()
+
+    def _refresh_periodically(self):
+        """refresh the control repository every interval seconds"""
+        while not self._stopped.wait(self._interval):
+            try:
+                self.refresh()
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.warning('could not refresh control repository: %s', exc)
+
+    def run(self, command, cli_args, stream):
+        """run a command and return its exit code"""
+        if command == 'ping':
+            return 0
+        if command == 'refresh':
+            try:
+                self.refresh()
+            except Exception as exc:  # pylint: disable=broad-except
+                stream.write('could not refresh control repository: %s\n' %
+                             exc)
+                return 1
+            return 0
+        if command not in self._handlers:
+            stream.write('unsupported command %s\n' % command)
+            return 1
+
+        with self._lock, redirect_stdout(stream):
+            try:
+                self._handlers[command](self._control_repo, cli_args)
+            except SystemExit as exc:
+                return exc.code if isinstance(exc.code, int) else 1
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.exception('daemon command %s failed', command)
+                cprint.red('crmngr daemon command failed: %s' % exc)
+                return 1
+            finally:
+                cprint.flush()
+        return 0
+
+    def serve(self):
+        """load the control repository and answer requests until stopped"""
+        if query(self._socket_path, 'ping') is not None:
+            raise DaemonError('crmngr daemon is already running on %s' %
+                              self._socket_path)
+        if os.path.exists(self._socket_path):
+            # left over by a daemon that has not been stopped cleanly
+            os.unlink(self._socket_path)
+
+        self.refresh()
+        server = _UnixServer(self._socket_path, _RequestHandler)
+        server.daemon = self
+        refresher = threading.Thread(target=self._refresh_periodically,
+                                     daemon=True)
+        refresher.start()
+        LOG.debug('crmngr daemon listening on %s', self._socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            self._stopped.set()
+            server.server_close()
+            os.unlink(self._socket_path)
+            if self._control_repo is not None:
+                self._control_repo.cleanup()
+
+
+def query(socket_path, command, args=None, *, stream=None):
+    """send a request to a running daemon and write its output to stream.
+
+    Returns the exit code of the command or None if no daemon is running.
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError as exc:
+        connection.close()
+        LOG.debug('no crmngr daemon running on %s: %s', socket_path, exc)
+        return None
+
+    if stream is None:
+        stream = sys.stdout
+    try:
+        tty = stream.isatty()
+    except (AttributeError, ValueError):
+        tty = False
+    with connection, connection.makefile('rwb') as sockfile:
+        _send(sockfile, {
+            'command': command,
+            'args': args or {},
+            'tty': tty and not os.environ.get('NO_COLOR'),
+        })
+        sockfile.flush()
+        for line in sockfile:
+            message = json.loads(line.decode('utf-8'))
+            if 'output' in message:
+                stream.write(message['output'])
+            elif 'exit' in message:
+                stream.flush()
+                return message['exit']
+    LOG.debug('crmngr daemon closed connection unexpectedly')
+    return 1
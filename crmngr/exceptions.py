@@ -0,0 +1,5 @@
+""" crmngr exceptions module """
+
+
+class NoEnvironmentError(Exception):
+    """exception raised when no environment is matched"""
@@ -3,12 +3,10 @@
 # stdlib
 from datetime import datetime
 import logging
-
-# 3rd-party
-import requests
-from requests.exceptions import RequestException
+import threading
 
 # crmngr
+from crmngr import timings
 from crmngr.utils import truncate
 
 LOG = logging.getLogger(__name__)
@@ -21,28 +19,101 @@ class ForgeError(Exception):
 class ForgeApi:
     """puppetforge module api"""
 
+    _lock = threading.Lock()
+    _session = None
+    _settings = {
+        'backoff_factor': 0.5,
+        'pool_size': 10,
+        'retries': 3,
+        'timeout': 30,
+        'url': 'https://forgeapi.puppetlabs.com',
+    }
+
+    # number of modules resolved with a single request by current_versions
+    BATCH_SIZE = 50
+    # maximum number of pages followed for a single batch
+    MAX_PAGES = 10
+
     def __init__(self, *, name, author):
         """initialize module api"""
         self._name = name
         self._author = author
-        self._url = '{forgeapi}/{author}-{module}'.format(
-            forgeapi='https://forgeapi.puppetlabs.com/v3/modules',
+        self._url = '{forgeapi}/v3/modules/{author}-{module}'.format(
+            forgeapi=self._settings['url'],
             author=self._author,
             module=self._name
         )
 
-    @property
-    def current_version(self):
-        """get version for current release"""
-        try:
-            LOG.debug('request info from %s', self._url)
-            api = requests.get(self._url)
-            api_info = api.json()['current_release']
-            LOG.debug('received module info from API: %s', truncate(api_info))
-        except (RequestException, KeyError) as exc:
-            LOG.debug('could not read from api: %s', exc)
-            raise ForgeError('could not read from api: %s' % exc) from None
+    @classmethod
+    def configure(cls, **settings):
+        """configure the http session shared by all api requests.
+
+        Supported settings are pool_size (number of pooled keep-alive
+        connections), timeout (in seconds), retries, backoff_factor (for
+        retries) and url (forge api base url).
+        """
+        with cls._lock:
+            unknown = set(settings) - set(cls._settings)
+            if unknown:
+                raise TypeError('unsupported settings: %s' % ', '.join(
+                    sorted(unknown)
+                ))
+            cls._settings = dict(cls._settings, **settings)
+            # the session is recreated with the new settings on next use
+            cls._session = None
+        LOG.debug('configured forge api: %s', cls._settings)
+
+    @classmethod
+    def session(cls):
+        """returns the pooled http session shared by all api requests"""
+        # requests is imported on first use, commands without forge access
+        # do not pay for importing it
+        # pylint: disable=import-outside-toplevel
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with cls._lock:
+            if cls._session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=cls._settings['pool_size'],
+                    pool_maxsize=cls._settings['pool_size'],
+                    max_retries=Retry(
+                        total=cls._settings['retries'],
+                        backoff_factor=cls._settings['backoff_factor'],
+                        status_forcelist=(429, 500, 502, 503, 504),
+                    ),
+                )
+                cls._session = requests.Session()
+                cls._session.mount('http://', adapter)
+                cls._session.mount('https://', adapter)
+            return cls._session
+
+    @classmethod
+    def _get(cls, url, params=None, *, listing=False):
+        """returns the decoded json response of an api request"""
+        session = cls.session()
+        # pylint: disable=import-outside-toplevel
+        from requests.exceptions import RequestException
+
+        LOG.debug('request info from %s (%s)', url, params)
+        with timings.measure('forge', 'GET /v3/modules' if listing else
+                             'GET /v3/modules/:slug'):
+            try:
+                return session.get(
+                    url,
+                    params=params,
+                    timeout=cls._settings['timeout'],
+                ).json()
+            except RequestException as exc:
+                LOG.debug('could not read from api: %s', exc)
+                raise ForgeError(
+                    'could not read from api: %s' % exc
+                ) from None
 
+    @staticmethod
+    def _parse_release(api_info):
+        """returns version info of a forge release"""
         try:
             return {
                 'version': api_info['version'],
@@ -54,17 +125,91 @@ class ForgeApi:
             LOG.debug('could not parse api response: %s', exc)
             raise ForgeError('could not parse api response: %s' % exc) from None
 
+    @property
+    def current_version(self):
+        """get version for current release"""
+        try:
+            api_info = self._get(self._url)['current_release']
+            LOG.debug('received module info from API: %s', truncate(api_info))
+        except (KeyError, ValueError) as exc:
+            LOG.debug('could not read from api: %s', exc)
+            raise ForgeError('could not read from api: %s' % exc) from None
+
+        return self._parse_release(api_info)
+
+    @classmethod
+    def current_versions(cls, forgenames):
+        """get versions for current releases of many modules.
+
+        forgenames is an iterable of modules in author/name format. They are
+        resolved in batches using the multi-module listing endpoint of the
+        forge. Returns a dict with the forgename as key and the version info
+        as value. Modules without (parseable) current release are omitted.
+        Raises ForgeError if the pagination of a batch loops or exceeds
+        MAX_PAGES pages.
+        """
+        slugs = {}
+        for forgename in forgenames:
+            slugs[forgename.replace('/', '-', 1).lower()] = forgename
+        slug_list = sorted(slugs)
+
+        versions = {}
+        for offset in range(0, len(slug_list), cls.BATCH_SIZE):
+            batch = slug_list[offset:offset + cls.BATCH_SIZE]
+            url = '{forgeapi}/v3/modules'.format(
+                forgeapi=cls._settings['url']
+            )
+            params = {
+                'slugs': ','.join(batch),
+                'limit': len(batch),
+                'exclude_fields': 'readme changelog license reference',
+            }
+            pages = set()
+            while url:
+                page = (url, tuple(sorted((params or {}).items())))
+                if page in pages:
+                    raise ForgeError('pagination loop at %s' % url)
+                if len(pages) >= cls.MAX_PAGES:
+                    raise ForgeError(
+                        'more than %s pages for a batch' % cls.MAX_PAGES
+                    )
+                pages.add(page)
+                try:
+                    api_info = cls._get(url, params, listing=True)
+                    results = api_info['results']
+                    LOG.debug('received module info from API: %s',
+                              truncate(results))
+                except (KeyError, ValueError) as exc:
+                    LOG.debug('could not read from api: %s', exc)
+                    raise ForgeError(
+                        'could not read from api: %s' % exc
+                    ) from None
+                for result in results:
+                    try:
+                        forgename = slugs[result['slug'].lower()]
+                        versions[forgename] = cls._parse_release(
+                            result['current_release']
+                        )
+                    except (AttributeError, KeyError, ForgeError):
+                        continue
+                # follow pagination, next contains the query string
+                next_page = (api_info.get('pagination') or {}).get('next')
+                if next_page:
+                    url = cls._settings['url'] + next_page
+                    params = None
+                else:
+                    url = None
+        return versions
+
     def has_version(self, version):
         """verify wheter a release with requested version exists."""
         try:
-            LOG.debug('request info from %s', self._url)
-            api = requests.get(self._url)
-            api_info = api.json()['releases']
+            api_info = self._get(self._url)['releases']
             LOG.debug(
                 'received module info from API: %s',
                 truncate(api_info),
             )
-        except (RequestException, KeyError) as exc:
+        except (KeyError, ValueError) as exc:
             LOG.debug('could not read from api: %s', exc)
             raise ForgeError('could not read from api: %s' % exc) from None
 
@@ -1,77 +1,867 @@
 """ crmngr git module """
 
 # stdlib
+import asyncio
 from collections import namedtuple
+from contextlib import contextmanager
+from contextlib import ExitStack
 from datetime import datetime
+import fcntl
 import logging
 import os
 import re
+import shutil
 import subprocess
 from tempfile import TemporaryDirectory
+import threading
+from urllib.parse import urlparse
+
+# crmngr
+from crmngr import timings
 
 LOG = logging.getLogger(__name__)
 
+# object filter used for partial clones
+PARTIAL_CLONE_FILTER = 'blob:none'
+
+# oldest git supporting all options in use (f.e. --filter=tree:0)
+MINIMUM_GIT_VERSION = (2, 20)
+
+GitBranchInfo = namedtuple('GitBranchInfo', ['name', 'date', 'author', 'sha'])
+GitTagDate = namedtuple('GitTagDate', ['name', 'date'])
+
 
 class GitError(Exception):
     """exception raised when a git command fails"""
 
 
+def git_version():
+    """returns the version of the git binary as tuple of ints"""
+    global _GIT_VERSION  # pylint: disable=global-statement
+    if _GIT_VERSION is None:
+        try:
+            output = subprocess.check_output(['git', '--version'],
+                                             universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as exc:
+            raise GitError('could not run git: %s' % exc) from exc
+        match = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', output)
+        if match is None:
+            raise GitError('could not determine git version from "%s"' %
+                           output.strip())
+        _GIT_VERSION = tuple(int(part or 0) for part in match.groups())
+        LOG.debug('git version is %s', '.'.join(map(str, _GIT_VERSION)))
+    return _GIT_VERSION
+
+
+_GIT_VERSION = None
+
+
+def check_git_version():
+    """verify the git binary is at least MINIMUM_GIT_VERSION"""
+    if git_version() < MINIMUM_GIT_VERSION:
+        raise GitError('crmngr requires git >= %s, found git %s' % (
+            '.'.join(map(str, MINIMUM_GIT_VERSION)),
+            '.'.join(map(str, git_version())),
+        ))
+
+
+@contextmanager
+def mirror_lock(mirror_dir, blocking=True, *, shared=False, kind='lock'):
+    """lock a mirror against concurrent use by other crmngr processes.
+
+    The lock is held on a lock file (mirror_dir.kind) next to mirror_dir.
+    Updates of a mirror hold the exclusive 'lock' lock. Repositories
+    created from a mirror hold a shared 'use' lock as long as they exist,
+    removing a mirror requires the exclusive 'use' lock. Yields whether or
+    not the lock has been acquired (always True if blocking).
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(mirror_dir)), exist_ok=True)
+    with open('%s.%s' % (mirror_dir, kind), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file,
+                        (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) |
+                        (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def tag_version_key(name):
+    """returns a key to sort tag names by version.
+
+    A leading v is ignored and pre-releases (f.e. 1.0.0-rc1) are ordered
+    before their release. Names which are not a version are ordered before
+    all versions.
+    """
+    def natural(text):
+        """returns a key comparing numbers within text numerically"""
+        return tuple((1, int(part), '') if part.isdigit() else (0, 0, part)
+                     for part in re.split(r'(\d+)', text) if part)
+
+    match = re.match(r'^[vV]?(?P<release>\d+(?:\.\d+)*)(?P<suffix>.*)$', name)
+    if match is None:
+        return (0, (), 0, natural(name))
+    release = [int(part) for part in match.group('release').split('.')]
+    # 1.0 and 1.0.0 are the same release
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    suffix = match.group('suffix')
+    # build metadata (f.e. 1.0.0+1) does not make a pre-release
+    final = not suffix or suffix.startswith('+')
+    return (1, tuple(release), 1 if final else 0, natural(suffix))
+
+
+def remote_host(url):
+    """returns the host of a git url or None for local repositories"""
+    if '://' in url:
+        return urlparse(url).hostname or None
+    # scp-like syntax: [user@]host:path
+    match = re.match(r'^(?:[^@/]+@)?(?P<host>[^:/]+):', url)
+    if match:
+        return match.group('host')
+    return None
+
+
+class GitExecutor:
+    """runs git commands as asyncio subprocesses.
+
+    The event loop runs in a background thread, so commands can be scheduled
+    from any thread. At most limit_per_host commands talking to the same
+    remote host (clone, fetch, ls-remote, push) run concurrently.
+    """
+
+    # subcommands connecting to the remote
+    REMOTE_COMMANDS = ('clone', 'fetch', 'ls-remote', 'push')
+
+    def __init__(self, limit_per_host=4):
+        """initialize executor"""
+        self._limit_per_host = limit_per_host
+        self._lock = threading.Lock()
+        self._loop = None
+        self._semaphores = {}
+
+    def configure(self, *, limit_per_host):
+        """set the number of concurrent commands per remote host"""
+        self._limit_per_host = limit_per_host
+        # semaphores are recreated with the new limit on next use
+        self._semaphores = {}
+        LOG.debug('configured git executor: %s commands per host',
+                  limit_per_host)
+
+    def _event_loop(self):
+        """returns the event loop, starting it on first use"""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever,
+                                 name='crmngr-git', daemon=True).start()
+            return self._loop
+
+    def submit(self, coroutine):
+        """schedule a coroutine, returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coroutine, self._event_loop())
+
+    def call(self, coroutine):
+        """run a coroutine and return its result"""
+        return self.submit(coroutine).result()
+
+    async def run(self, cmds, cwd=None, *, remote=None, input=None,
+                  env=None):  # pylint: disable=redefined-builtin
+        """execute a git command and return its output.
+
+        remote is the url of the remote the command talks to. It is used to
+        limit the concurrent commands per host.
+        """
+        cmds = ['git'] + cmds
+        # configuration overrides (-c name=value) are not part of the
+        # subcommand
+        subcommand = next(cmd for index, cmd in enumerate(cmds[1:])
+                          if not cmd.startswith('-') and cmds[index] != '-c')
+        host = None
+        if remote is not None and subcommand in self.REMOTE_COMMANDS:
+            host = remote_host(remote)
+        if host is None:
+            return await self._run(cmds, subcommand, cwd, input, env)
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self._limit_per_host)
+        async with self._semaphores[host]:
+            return await self._run(cmds, subcommand, cwd, input, env)
+
+    @staticmethod
+    async def _run(cmds, subcommand, cwd, input,
+                   env):  # pylint: disable=redefined-builtin
+        """execute a git command and return its output"""
+        with timings.measure('git', subcommand):
+            process = await asyncio.create_subprocess_exec(
+                *cmds,
+                stdin=None if input is None else subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                cwd=cwd,
+                env=env,
+            )
+            output, _ = await process.communicate(
+                None if input is None else input.encode('utf-8')
+            )
+        output = output.decode('utf-8', errors='replace').replace(
+            '\r\n', '\n'
+        )
+        if process.returncode:
+            raise GitError(
+                'command "%s" failed with exit code "%s" and output: "%s"' % (
+                    ' '.join(cmds),
+                    process.returncode,
+                    output.replace('\n', '; ').strip('; '),
+                )
+            )
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(
+                'command "%s" completed with exit code "0" and output: "%s"',
+                ' '.join(cmds),
+                output.replace('\n', '; ').strip('; '),
+            )
+        return output
+
+
+EXECUTOR = GitExecutor()
+
+
+def git(cmds, cwd=None, **kwargs):
+    """execute a git command"""
+    return EXECUTOR.call(EXECUTOR.run(cmds, cwd, **kwargs))
+
+
+async def _ls_remote(url, *patterns, heads=False, tags=False):
+    """list references of a remote repository without cloning it"""
+    cmds = ['ls-remote']
+    if heads:
+        cmds.append('--heads')
+    if tags:
+        cmds.append('--tags')
+    references = {}
+    output = await EXECUTOR.run(cmds + [url] + list(patterns), remote=url)
+    for line in output.splitlines():
+        try:
+            sha, reference = line.split('\t', 1)
+        except ValueError:
+            continue
+        references[reference] = sha
+    return references
+
+
+def ls_remote(url, *patterns, heads=False, tags=False):
+    """list references of a remote repository without cloning it.
+
+    Returns a dict with the reference names as keys and the object names
+    (sha1) as values. Peeled tags are returned with a ^{} suffix.
+    """
+    return EXECUTOR.call(_ls_remote(url, *patterns, heads=heads, tags=tags))
+
+
+def remote_branches(url, *, details=False):
+    """returns a list of namedtuples of (name, date, author) for all branches
+    of a remote repository without cloning it.
+
+    Without details, the branches are listed with a single ls-remote call and
+    date and author are None. With details, only the head commits of all
+    branches are fetched (without any trees or blobs) into a temporary
+    repository to read date and author of the last commit.
+    """
+    if not details:
+        return [
+            GitBranchInfo(name=reference[len('refs/heads/'):], date=None,
+                          author=None, sha=sha)
+            for reference, sha in sorted(ls_remote(url, heads=True).items())
+        ]
+
+    with TemporaryDirectory(prefix='crmngr_branches_') as tmpdir:
+        git(['init', '--quiet', '--bare'], cwd=tmpdir)
+        git([
+            'fetch',
+            '--quiet',
+            '--depth=1',
+            '--filter=tree:0',
+            '--no-tags',
+            url,
+            '+refs/heads/*:refs/heads/*',
+        ], cwd=tmpdir, remote=url)
+        branches = _branch_details(tmpdir, 'refs/heads/')
+    return branches
+
+
+def _branch_details(cwd, prefix):
+    """returns a list of namedtuples of (name, date, author, sha) for all
+    refs below prefix"""
+    branches = []
+    for line in git([
+            'for-each-ref',
+            '--format=%(refname)%00%(committerdate:iso)%00%(authorname)'
+            '%00%(objectname)',
+            prefix,
+    ], cwd=cwd).splitlines():
+        name, date, author, sha = line.split('\0')
+        name = name[len(prefix):]
+        if name == 'HEAD':
+            continue
+        branches.append(GitBranchInfo(
+            name=name,
+            date=datetime.strptime(date, '%Y-%m-%d %H:%M:%S %z'),
+            author=author,
+            sha=sha,
+        ))
+    return branches
+
+
+def _ref_names(cwd, prefix):
+    """returns a dict with the names (without prefix) of all refs below
+    prefix as keys and their sha1 as values"""
+    refs = {}
+    for line in git([
+            'for-each-ref', '--format=%(objectname) %(refname)', prefix,
+    ], cwd=cwd).splitlines():
+        sha, name = line.split(' ', 1)
+        name = name[len(prefix):]
+        if name != 'HEAD':
+            refs[name] = sha
+    return refs
+
+
+async def _latest_remote_tag(url):
+    """returns a namedtuple of (name, date) for the newest tag of a remote"""
+    tag_names = set(
+        reference[len('refs/tags/'):].rsplit('^{}', 1)[0]
+        for reference in await _ls_remote(url, tags=True)
+    )
+    if not tag_names:
+        raise GitError('no tags found in repository %s' % url)
+    tag_name = max(tag_names, key=tag_version_key)
+
+    date = None
+    with TemporaryDirectory(prefix='crmngr_tag_') as tmpdir:
+        try:
+            await EXECUTOR.run(['init', '--quiet', '--bare'], cwd=tmpdir)
+            await EXECUTOR.run([
+                'fetch',
+                '--quiet',
+                '--depth=1',
+                '--filter=tree:0',
+                '--no-tags',
+                url,
+                'refs/tags/%s' % tag_name,
+            ], cwd=tmpdir, remote=url)
+            date = datetime.strptime((await EXECUTOR.run(
+                ['show', '-s', '--format=%ci', 'FETCH_HEAD^{commit}'],
+                cwd=tmpdir,
+            )).strip(), '%Y-%m-%d %H:%M:%S %z')
+        except (GitError, ValueError) as exc:
+            LOG.debug('could not determine date of tag %s in repository %s: '
+                      '%s', tag_name, url, exc)
+
+    return GitTagDate(name=tag_name, date=date)
+
+
+def latest_remote_tag(url):
+    """returns a namedtuple of (name, date) for the newest tag of a remote.
+
+    The newest tag is determined by version-aware sorting of the tag names
+    of a single ls-remote call. To determine the date, only the winning tag
+    is fetched (without any trees or blobs) into a temporary repository. If
+    this is not possible, date is None.
+    """
+    return EXECUTOR.call(_latest_remote_tag(url))
+
+
+def latest_remote_tags(urls):
+    """returns a dict with urls as keys and a namedtuple of (name, date) for
+    the newest tag of each remote as values.
+
+    All remotes are queried concurrently (limited per host). The value is
+    None for remotes without tags or that cannot be read.
+    """
+    async def gather():
+        """query all remotes concurrently"""
+        return await asyncio.gather(
+            *(_latest_remote_tag(url) for url in urls),
+            return_exceptions=True
+        )
+
+    urls = list(urls)
+    latest_tags = {}
+    for url, result in zip(urls, EXECUTOR.call(gather())):
+        if isinstance(result, GitError):
+            LOG.debug('could not determine latest tag of %s: %s', url, result)
+            result = None
+        elif isinstance(result, BaseException):
+            raise result
+        latest_tags[url] = result
+    return latest_tags
+
+
+class RemoteRepository:
+    """a remote git repository queried without cloning it"""
+
+    def __init__(self, url):
+        """verify url is a git repository"""
+        self._url = url
+        ls_remote(self._url, 'HEAD')
+
+    def _validate_ref(self, reference, kind, name):
+        """verify if repository has a specific reference"""
+        # patterns match the end of reference names, verify the exact name
+        if reference not in ls_remote(self._url, reference):
+            raise GitError(
+                "{kind} {name} not found for repository {url}".format(
+                    kind=kind,
+                    name=name,
+                    url=self._url
+                )
+            )
+
+    def validate_branch(self, branch):
+        """verify if repository has a specific branch"""
+        self._validate_ref('refs/heads/%s' % branch, 'Branch', branch)
+
+    def validate_tag(self, tag):
+        """verify if repository has a specific tag"""
+        self._validate_ref('refs/tags/%s' % tag, 'Tag', tag)
+
+    def validate_commit(self, commit):
+        """verify if repository has a specific commit.
+
+        Only the commit itself is fetched (without any trees or blobs) into a
+        temporary repository. This requires the full sha1 and a server which
+        allows fetching unadvertised commits (f.e. with protocol version 2).
+        """
+        with TemporaryDirectory(prefix='crmngr_commit_') as tmpdir:
+            try:
+                git(['init', '--quiet', '--bare'], cwd=tmpdir)
+                git([
+                    'fetch',
+                    '--quiet',
+                    '--depth=1',
+                    '--filter=tree:0',
+                    '--no-tags',
+                    self._url,
+                    commit,
+                ], cwd=tmpdir, remote=self._url)
+                output = git(['cat-file', '-t', commit], cwd=tmpdir).strip()
+            except GitError as exc:
+                LOG.debug('could not fetch commit %s of repository %s: %s',
+                          commit, self._url, exc)
+                output = None
+        if output != 'commit':
+            raise GitError(
+                "Commit {commit} not found for repository {url}".format(
+                    commit=commit,
+                    url=self._url
+                )
+            )
+
+    @property
+    def latest_tag(self):
+        """returns a namedtuple of (name, date) for the newest tag"""
+        return latest_remote_tag(self._url)
+
+    @property
+    def url(self):
+        """returns repository url"""
+        return self._url
+
+
+class GitBatch:
+    """long-lived git cat-file --batch (or --batch-check) process.
+
+    Object names are written in chunks small enough to fit into the pipe
+    buffer before their answers are read, so a single process serves any
+    number of queries without a round trip per object.
+    """
+
+    # number of object names written before reading the answers
+    CHUNK_SIZE = 64
+
+    def __init__(self, cwd, *, check=False):
+        """start batch process"""
+        self._cmds = ['git', 'cat-file',
+                      '--batch-check' if check else '--batch']
+        self._check = check
+        self._lock = threading.Lock()
+        LOG.debug('start batch command "%s"', ' '.join(self._cmds))
+        self._process = subprocess.Popen(
+            self._cmds,
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+    def query(self, name):
+        """returns a tuple of (sha1, type, content) for an object name.
+
+        content is None for --batch-check. Returns None if the object does
+        not exist.
+        """
+        return self.query_many([name])[name]
+
+    def query_many(self, names):
+        """returns a dict with the object names as keys and the result of
+        query as values"""
+        names = list(names)
+        results = {}
+        for offset in range(0, len(names), self.CHUNK_SIZE):
+            chunk = names[offset:offset + self.CHUNK_SIZE]
+            with self._lock, timings.measure('git', ' '.join(self._cmds[1:])):
+                self._process.stdin.write(b''.join(
+                    name.encode('utf-8') + b'\n' for name in chunk
+                ))
+                self._process.stdin.flush()
+                for name in chunk:
+                    results[name] = self._read_answer(name)
+        return results
+
+    def _read_answer(self, name):
+        """read the answer to a single query"""
+        header = self._process.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:
+            LOG.debug('object %s not found: %s', name, header)
+            return None
+        content = None
+        if not self._check:
+            content = self._process.stdout.read(int(header[2]))
+            # every object is terminated by a newline
+            self._process.stdout.read(1)
+        return header[0], header[1], content
+
+    def close(self):
+        """stop batch process"""
+        self._process.stdin.close()
+        self._process.stdout.close()
+        if self._process.wait():
+            LOG.debug('batch command "%s" exited with code %s',
+                      ' '.join(self._cmds), self._process.returncode)
+
+
 class Repository:
     """a git repository"""
 
-    def __init__(self, clone_url):
-        """clone a remote repository"""
+    def __init__(self, clone_url, *, mirror_dir=None, branches=None,
+                 partial=False):
+        """clone a remote repository
+
+        If mirror_dir is specified, a persistent bare mirror of the remote
+        repository is kept in this directory. The mirror is updated with an
+        incremental fetch and the working copy is created from it, sharing
+        its objects.
+
+        If branches is specified, only these branches are fetched instead of
+        all branches of the remote repository.
+
+        If partial is True, the repository is fetched as partial clone without
+        any file contents. File contents are fetched on demand.
+        """
         self._url = clone_url
+        self._mirror_dir = mirror_dir
+        self._partial = partial
+        self._batches = {}
+        self._locks = ExitStack()
         self._tmpdir = TemporaryDirectory(prefix='crmngr_repository_')
-        self.git([
-            'clone',
-            '--depth=1',
-            '--quiet',
-            '--no-single-branch',
-            self._url,
-            'git'
-        ], cwd=self._tmpdir.name)
         self._workdir = os.path.join(self._tmpdir.name, 'git')
-        LOG.debug('cloned %s into %s', self._url, self._workdir)
+        if self._mirror_dir is None and branches is None:
+            self.git([
+                'clone',
+                '--depth=1',
+                '--quiet',
+                '--no-single-branch',
+            ] + self._filter_args + (
+                # do not fetch the files of the default branch
+                ['--no-checkout'] if self._partial else []
+            ) + [
+                self._url,
+                'git'
+            ], cwd=self._tmpdir.name)
+            if self._partial:
+                # servers without partial clone support send all objects
+                self._partial = self._is_promisor(self._workdir)
+            LOG.debug('cloned %s into %s', self._url, self._workdir)
+        elif self._mirror_dir is None:
+            self.git(['init', '--quiet', 'git'], cwd=self._tmpdir.name)
+            self.git(['remote', 'add', 'origin', self._url])
+            if self._partial:
+                self._configure_promisor(self._workdir)
+            if branches:
+                self.git(['fetch', '--depth=1', '--quiet'] +
+                         self._filter_args + ['origin'] + [
+                    '+refs/heads/{0}:refs/remotes/origin/{0}'.format(branch)
+                    for branch in branches
+                ])
+            LOG.debug('fetched branches %s of %s into %s',
+                      branches, self._url, self._workdir)
+        else:
+            # the working copy borrows the objects of the mirror, it must not
+            # be removed as long as the working copy is in use
+            self._locks.enter_context(
+                mirror_lock(self._mirror_dir, shared=True, kind='use')
+            )
+            with mirror_lock(self._mirror_dir):
+                self._update_mirror(branches)
+                self._clone_mirror(branches)
+            LOG.debug('created %s from mirror %s of %s',
+                      self._workdir, self._mirror_dir, self._url)
+
+    @property
+    def _filter_args(self):
+        """returns the object filter arguments for clone and fetch"""
+        if self._partial:
+            return ['--filter=%s' % PARTIAL_CLONE_FILTER]
+        return []
+
+    def _configure_promisor(self, git_dir):
+        """configure origin as promisor remote.
+
+        Objects omitted by a partial clone are then fetched on demand from
+        origin.
+        """
+        for key, value in (
+                ('core.repositoryformatversion', '1'),
+                ('extensions.partialClone', 'origin'),
+                ('remote.origin.promisor', 'true'),
+                ('remote.origin.partialclonefilter', PARTIAL_CLONE_FILTER),
+        ):
+            self.git(['config', key, value], cwd=git_dir)
+
+    def _is_promisor(self, git_dir):
+        """returns whether or not origin is a promisor remote"""
+        try:
+            return self.git(
+                ['config', '--bool', 'remote.origin.promisor'], cwd=git_dir
+            ).strip() == 'true'
+        except GitError:
+            return False
+
+    def _update_mirror(self, branches=None):
+        """create or incrementally update the local bare mirror.
+
+        If branches is specified, only these branches are updated.
+        """
+        if os.path.isdir(self._mirror_dir):
+            try:
+                mirror_url = self.git(
+                    ['config', 'remote.origin.url'], cwd=self._mirror_dir
+                ).strip()
+            except GitError:
+                mirror_url = None
+            if mirror_url != self._url:
+                LOG.debug('mirror %s does not track %s. Recreate it.',
+                          self._mirror_dir, self._url)
+                shutil.rmtree(self._mirror_dir)
+
+        if not os.path.isdir(self._mirror_dir):
+            os.makedirs(self._mirror_dir)
+            self.git(['init', '--bare', '--quiet'], cwd=self._mirror_dir)
+            self.git(['remote', 'add', 'origin', self._url],
+                     cwd=self._mirror_dir)
+            self.git(
+                ['config', 'remote.origin.fetch',
+                 '+refs/heads/*:refs/heads/*'],
+                cwd=self._mirror_dir,
+            )
+            LOG.debug('created mirror %s', self._mirror_dir)
+
+        if self._is_promisor(self._mirror_dir):
+            # a mirror created as partial clone stays a partial clone, missing
+            # objects are fetched on demand
+            self._partial = True
+        elif self._partial:
+            self._configure_promisor(self._mirror_dir)
+
+        if branches is None:
+            self.git(
+                ['fetch', '--quiet', '--prune'] + self._filter_args +
+                ['origin'],
+                cwd=self._mirror_dir,
+            )
+        elif branches:
+            self.git(['fetch', '--quiet', '--prune'] + self._filter_args +
+                     ['origin'] + [
+                '+refs/heads/{0}:refs/heads/{0}'.format(branch)
+                for branch in branches
+            ], cwd=self._mirror_dir)
+        LOG.debug('updated mirror %s', self._mirror_dir)
+
+    def _clone_mirror(self, branches=None):
+        """create working copy borrowing all objects from the mirror.
+
+        If branches is specified, only these branches are created as remote
+        branches in the working copy. Tags of the mirror are created as tags.
+        """
+        self.git(['init', '--quiet', 'git'], cwd=self._tmpdir.name)
+        with open(os.path.join(self._workdir, '.git', 'objects', 'info',
+                               'alternates'), 'w') as alternates:
+            alternates.write(
+                '%s\n' % os.path.join(os.path.abspath(self._mirror_dir),
+                                      'objects')
+            )
+        self.git(['remote', 'add', 'origin', self._url])
+        if self._partial:
+            self._configure_promisor(self._workdir)
+        # the mirror has all objects, only refs need to be created
+        heads = {}
+        tags = {}
+        for line in self.git(
+                ['for-each-ref', '--format=%(objectname) %(refname)',
+                 'refs/heads/', 'refs/tags/'],
+                cwd=self._mirror_dir,
+        ).splitlines():
+            sha, ref = line.split(' ', 1)
+            if ref.startswith('refs/tags/'):
+                tags[ref] = sha
+            else:
+                heads[ref[len('refs/heads/'):]] = sha
+        if branches is not None:
+            wanted = set(branches)
+            heads = {branch: sha for branch, sha in heads.items()
+                     if branch in wanted}
+        self.git(['update-ref', '--stdin'], input=''.join(
+            'create refs/remotes/origin/{branch} {sha}\n'.format(
+                sha=sha, branch=branch,
+            )
+            for branch, sha in sorted(heads.items())
+        ) + ''.join(
+            'create {tag} {sha}\n'.format(sha=sha, tag=tag)
+            for tag, sha in sorted(tags.items())
+        ))
 
     def __enter__(self):
         return self
 
     def __exit__(self, *args):
+        self.cleanup()
+
+    def cleanup(self):
+        """stop batch processes and remove the working copy"""
+        for batch in self._batches.values():
+            batch.close()
+        self._batches = {}
         self._tmpdir.cleanup()
+        self._locks.close()
+
+    def batch(self, *, check=False):
+        """returns the long-lived GitBatch of the working copy"""
+        if check not in self._batches:
+            self._batches[check] = GitBatch(self._workdir, check=check)
+        return self._batches[check]
 
     def git(self, cmds, cwd=None, **kwargs):
         """execute a git command"""
-        cmds = ['git'] + cmds
         if cwd is None:
             cwd = self._workdir
+        kwargs.setdefault('remote', self._url)
+        return git(cmds, cwd=cwd, **kwargs)
 
+    def object_names(self, objects):
+        """resolve object names (f.e. "<rev>:<path>") to their sha1.
+
+        The objects themselves are not read. Returns a dict with the object
+        name as key and the sha1 as value. Objects which do not exist are
+        omitted.
+        """
+        # rev-parse only resolves names, unlike cat-file --batch-check it
+        # does not fetch missing blobs of a partial clone one by one
+        objects = list(objects)
+        if not objects:
+            return {}
         try:
-            rval = subprocess.check_output(
-                cmds,
-                stderr=subprocess.STDOUT,
-                cwd=cwd,
-                universal_newlines=True,
-                **kwargs
-            )
-            LOG.debug(
-                'command "%s" completed with exit code "0" and output: "%s"',
-                ' '.join(cmds),
-                rval.replace('\n', '; ').strip('; '),
+            shas = self.git(['rev-parse'] + objects).split()
+            if len(shas) == len(objects):
+                return dict(zip(objects, shas))
+        except GitError as exc:
+            LOG.debug('not all objects exist, resolve them one by one: %s',
+                      exc)
+
+        async def resolve(name, slots):
+            """returns the sha1 of name or None if it does not exist"""
+            async with slots:
+                try:
+                    return (await EXECUTOR.run(
+                        ['rev-parse', '--verify', '--quiet', name],
+                        cwd=self._workdir,
+                    )).strip()
+                except GitError:
+                    LOG.debug('object %s does not exist', name)
+                    return None
+
+        async def resolve_all():
+            """resolve all names concurrently, with one command per cpu"""
+            slots = asyncio.Semaphore(os.cpu_count() or 1)
+            return await asyncio.gather(*(resolve(name, slots)
+                                          for name in objects))
+
+        resolved = {name: sha
+                    for name, sha in zip(objects, EXECUTOR.call(resolve_all()))
+                    if sha}
+        LOG.debug('resolved %s object names', len(resolved))
+        return resolved
+
+    def cat_files(self, objects):
+        """read objects through the long-lived git cat-file --batch process.
+
+        objects is an iterable of object names (f.e. "<rev>:<path>"). Yields
+        a tuple of (object name, content) for every object. Content is
+        decoded as text or None if the object does not exist.
+
+        In a partial clone, objects should be object names (sha1). They are
+        fetched with a single request before being read.
+        """
+        objects = list(objects)
+        if self._partial and objects:
+            self.fetch_objects(objects)
+
+        batch = self.batch()
+        # read chunk by chunk to not keep all contents in memory
+        for offset in range(0, len(objects), batch.CHUNK_SIZE):
+            for name, info in batch.query_many(
+                    objects[offset:offset + batch.CHUNK_SIZE]).items():
+                if info is None:
+                    yield name, None
+                    continue
+                _, object_type, content = info
+                LOG.debug('read %s (%s, %s bytes) from batch', name,
+                          object_type, len(content))
+                yield name, content.decode('utf-8', errors='replace')
+
+    def fetch_objects(self, objects):
+        """fetch objects (sha1) omitted by a partial clone from origin.
+
+        In mirror mode, the objects are fetched into the mirror, so they are
+        available to subsequent runs.
+        """
+        # without negotiation, the server would omit objects reachable from
+        # commits the repository already has
+        cmds = ['-c', 'fetch.negotiationAlgorithm=noop', 'fetch', '--quiet',
+                '--no-tags']
+        if git_version() >= (2, 29):
+            self.git(
+                cmds + ['--no-write-fetch-head', '--stdin'] +
+                self._filter_args + ['origin'],
+                cwd=self._mirror_dir or self._workdir,
+                input=''.join('%s\n' % sha for sha in objects),
             )
-        except subprocess.CalledProcessError as exc:
-            raise GitError(
-                'command "%s" failed with exit code "%s" and output: "%s"' % (
-                    ' '.join(cmds),
-                    exc.returncode,
-                    exc.output.replace('\n', '; ').strip('; '),
+        else:
+            # fetch --stdin is not available, pass objects as arguments
+            for offset in range(0, len(objects), 500):
+                self.git(
+                    cmds + self._filter_args + ['origin'] +
+                    list(objects[offset:offset + 500]),
+                    cwd=self._mirror_dir or self._workdir,
                 )
-            ) from None
-        return rval
+        LOG.debug('fetched %s objects from %s', len(objects), self._url)
 
     def validate_branch(self, branch):
         """verify if repository has a specific branch"""
-        if not self.git(['branch', '--list', '--all', 'origin/%s' % branch]):
+        if branch not in _ref_names(self._workdir, 'refs/remotes/origin/'):
             raise GitError(
                 "Branch {branch} not found for repository {url}".format(
                     branch=branch,
@@ -81,7 +871,7 @@ class Repository:
 
     def validate_tag(self, tag):
         """verify if repository has a specific tag"""
-        if not self.git(['tag', '--list', tag]):
+        if tag not in _ref_names(self._workdir, 'refs/tags/'):
             raise GitError(
                 "Tag {tag} not found for repository {url}".format(
                     tag=tag,
@@ -91,9 +881,9 @@ class Repository:
 
     def validate_commit(self, commit):
         """verify if repository has a specific commit"""
-        output = self.git(['cat-file', '-t', commit]).strip()
+        info = self.batch(check=True).query(commit)
 
-        if output != 'commit':
+        if info is None or info[1] != 'commit':
             raise GitError(
                 "Commit {commit} not found for repository {url}".format(
                     commit=commit,
@@ -101,44 +891,130 @@ class Repository:
                 )
             )
 
+    def branch_details(self):
+        """returns a list of namedtuples of (name, date, author, sha) for all
+        branches fetched into the working copy"""
+        return _branch_details(self._workdir, 'refs/remotes/origin/')
+
     @property
     def branches(self):
-        """returns all """
-        gitbranches = self.git(['branch', '--list', '--all']).split('\n')
-
-        re_branch = re.compile(r'\s*remotes/origin/(?P<branch>[^\s]+$)')
-
-        for gitbranch in gitbranches:
-            try:
-                yield re_branch.match(gitbranch).groupdict()['branch']
-            except AttributeError:
-                continue
+        """returns the names of all branches fetched into the working copy"""
+        yield from sorted(_ref_names(self._workdir, 'refs/remotes/origin/'))
 
     @property
     def latest_tag(self):
         """returns a namedtuple of (name, date) for the newest tag"""
-        Tag = namedtuple(  # pylint: disable=invalid-name
-            'GitTagDate', ['name', 'date']
-        )
-
+        if self._mirror_dir is not None:
+            # the mirror has just been fetched, no need to ask the remote
+            return self._latest_local_tag()
         try:
-            self.git(['fetch', '--tags'])
-            # get sha1 for latest tag
-            cid = self.git(['rev-list', '--tags', '--max-count=1']).strip()
-            # get tag name from sha1
-            tag_name = self.git(['describe', '--tags', cid]).strip()
-            # get date for tag
-            date = datetime.strptime(self.git(
-                ['show', '-s', '--format=%ci', '%s^{commit}' % tag_name],
-            ).strip(), '%Y-%m-%d %H:%M:%S %z')
+            return latest_remote_tag(self._url)
         except GitError as exc:
             LOG.debug('could not determine latest tag in repository %s: %s',
                       self._url, exc)
             raise
 
-        return Tag(name=tag_name, date=date)
+    def _latest_local_tag(self):
+        """returns a namedtuple of (name, date) for the newest tag of the
+        working copy"""
+        tags = {}
+        for line in self.git([
+                'for-each-ref',
+                # committer date of lightweight or annotated tags
+                '--format=%(refname:strip=2)%00%(committerdate:iso)'
+                '%(*committerdate:iso)',
+                'refs/tags/',
+        ]).splitlines():
+            name, date = line.split('\0')
+            tags[name] = date
+        if not tags:
+            raise GitError('no tags found in repository %s' % self._url)
+        tag_name = max(tags, key=tag_version_key)
+        try:
+            date = datetime.strptime(tags[tag_name], '%Y-%m-%d %H:%M:%S %z')
+        except ValueError:
+            date = None
+        return GitTagDate(name=tag_name, date=date)
 
     @property
     def url(self):
         """returns repository url"""
         return self._url
+
+
+class MirrorStore:
+    """persistent bare mirrors of remote repositories below directory.
+
+    Mirrors are keyed by name (f.e. the cachename of a module), track all
+    branches and tags of their remote and are updated incrementally on use.
+    If the mirrors exceed max_size bytes in total, the least recently used
+    mirrors not in use by a Repository (of any crmngr process) are removed.
+    """
+
+    def __init__(self, directory, *, max_size):
+        """initialize mirror store"""
+        self._directory = directory
+        self._max_size = max_size
+
+    def repository(self, name, url):
+        """returns a Repository of url created from the mirror name.
+
+        The mirror is not removed as long as the repository is in use.
+        """
+        mirror_dir = os.path.join(self._directory, name)
+        # the mirror must not be removed before Repository locks it
+        with mirror_lock(mirror_dir, shared=True, kind='use'):
+            with mirror_lock(mirror_dir):
+                if not os.path.isdir(mirror_dir):
+                    os.makedirs(mirror_dir)
+                    git(['init', '--bare', '--quiet'], cwd=mirror_dir)
+                    git(['remote', 'add', 'origin', url], cwd=mirror_dir)
+                    git(['config', 'remote.origin.fetch',
+                         '+refs/heads/*:refs/heads/*'], cwd=mirror_dir)
+                    git(['config', '--add', 'remote.origin.fetch',
+                         '+refs/tags/*:refs/tags/*'], cwd=mirror_dir)
+                    LOG.debug('created module mirror %s for %s',
+                              mirror_dir, url)
+                # the modification time of a mirror records its last use
+                os.utime(mirror_dir)
+            # Repository locks the mirror while updating it
+            repository = Repository(url, mirror_dir=mirror_dir)
+        self.evict(keep=name)
+        return repository
+
+    def evict(self, keep=None):
+        """remove least recently used mirrors (except keep) until the store
+        does not exceed max_size"""
+        try:
+            names = os.listdir(self._directory)
+        except FileNotFoundError:
+            return
+        mirrors = []
+        for name in names:
+            mirror_dir = os.path.join(self._directory, name)
+            if not os.path.isdir(mirror_dir):
+                # lock files
+                continue
+            size = 0
+            for root, _, files in os.walk(mirror_dir):
+                for filename in files:
+                    try:
+                        size += os.lstat(os.path.join(root, filename)).st_size
+                    except OSError:
+                        continue
+            mirrors.append((os.stat(mirror_dir).st_mtime, name, size))
+        total = sum(size for _, _, size in mirrors)
+        for _, name, size in sorted(mirrors):
+            if total <= self._max_size:
+                break
+            if name == keep:
+                continue
+            mirror_dir = os.path.join(self._directory, name)
+            with mirror_lock(mirror_dir, blocking=False, kind='use') as locked:
+                if not locked:
+                    LOG.debug('mirror %s is in use, do not remove it', name)
+                    continue
+                LOG.debug('remove least recently used mirror %s (%s bytes)',
+                          name, size)
+                shutil.rmtree(mirror_dir, ignore_errors=True)
+            total -= size
@@ -2,27 +2,184 @@
 
 # stdlib
 from collections import namedtuple
+from concurrent.futures import Future
 import hashlib
 import logging
 from datetime import datetime
+import queue
+import threading
+from weakref import WeakValueDictionary
 
 # crmngr
 from crmngr import cprint
+from crmngr import timings
 from crmngr.forgeapi import ForgeApi
 from crmngr.forgeapi import ForgeError
 from crmngr.git import GitError
-from crmngr.git import Repository
+from crmngr.git import latest_remote_tag
 
 LOG = logging.getLogger(__name__)
 
+# version of the serialized form of modules (PuppetModule.serialize), needs
+# to be incremented on every change to invalidate cached parse results
+SERIALIZATION_VERSION = 1
+
+# shared instances of all modules in use, keyed by their serialized form
+_INTERNED_MODULES = WeakValueDictionary()
+
+
+def intern_module(module):
+    """returns the shared instance of a module.
+
+    Identical module pins (f.e. the same forge module version in hundreds of
+    environments) are represented by a single immutable object.
+    """
+    return _INTERNED_MODULES.setdefault(module.key, module)
+
+
+class LatestVersions:
+    """memoizes the latest versions of puppet modules for a single run.
+
+    Every cachename is only looked up once (using version_cache as
+    persistent cache), concurrent requests for the same cachename wait for
+    the same lookup. Stale versions (read from an expired cache entry) are
+    returned immediately and refreshed in the background, so the cache is up
+    to date for the next run.
+    """
+
+    # number of concurrent background refreshes of stale versions
+    REFRESH_WORKERS = 4
+    # seconds to wait for background refreshes at the end of a report
+    REFRESH_TIMEOUT = 30
+
+    def __init__(self, version_cache=None):
+        """initialize latest versions"""
+        self._version_cache = version_cache
+        self._lock = threading.Lock()
+        self._futures = {}
+        self._refreshes = queue.Queue()
+        self._refresh_workers = []
+
+    def __contains__(self, cachename):
+        """returns whether or not cachename is resolved or in progress"""
+        return cachename in self._futures
+
+    @property
+    def version_cache(self):
+        """persistent cache used for lookups"""
+        return self._version_cache
+
+    def get(self, module):
+        """returns the latest version of a puppet module"""
+        with self._lock:
+            future = self._futures.get(module.cachename)
+            lookup = future is None
+            if lookup:
+                future = self._futures[module.cachename] = Future()
+        if not lookup:
+            LOG.debug('latest version of %s already requested',
+                      module.cachename)
+            return future.result()
+
+        try:
+            future.set_result(module.get_latest_version(self._version_cache))
+        except BaseException as exc:
+            # do not memoize failures, the next request tries again
+            with self._lock:
+                del self._futures[module.cachename]
+            future.set_exception(exc)
+            raise
+        if future.result().stale:
+            self._refresh(module)
+        return future.result()
+
+    def set(self, module, version):
+        """record the latest version of a module resolved elsewhere (f.e. in
+        bulk or from a cache entry read before)"""
+        future = Future()
+        future.set_result(version)
+        with self._lock:
+            if self._futures.setdefault(module.cachename, future) is not future:
+                return
+        if version.stale:
+            self._refresh(module)
+
+    def _refresh(self, module):
+        """update the cached latest version of a module in the background"""
+        self._refreshes.put(module)
+        with self._lock:
+            if len(self._refresh_workers) < self.REFRESH_WORKERS:
+                # daemon threads do not delay the exit of the interpreter
+                worker = threading.Thread(target=self._refresh_worker,
+                                          name='crmngr-refresh', daemon=True)
+                self._refresh_workers.append(worker)
+                worker.start()
+
+    def _refresh_worker(self):
+        """look up and cache the latest versions of queued modules.
+
+        Workers exit as soon as the queue is empty, so no idle threads are
+        left behind by long running processes.
+        """
+        while True:
+            with self._lock:
+                try:
+                    module = self._refreshes.get_nowait()
+                except queue.Empty:
+                    self._refresh_workers.remove(threading.current_thread())
+                    return
+            try:
+                LOG.debug('refresh stale latest version of %s',
+                          module.cachename)
+                with timings.measure('cache', 'refresh'):
+                    module.get_latest_version(self._version_cache,
+                                              refresh=True)
+            except Exception as exc:  # pylint: disable=broad-except
+                LOG.debug('could not refresh latest version of %s: %s',
+                          module.cachename, exc)
+            finally:
+                self._refreshes.task_done()
+
+    def wait(self, timeout=None):
+        """wait up to timeout seconds for background refreshes to complete.
+
+        Returns the number of refreshes which are still queued or running.
+        """
+        refreshes = self._refreshes
+        with refreshes.all_tasks_done:
+            refreshes.all_tasks_done.wait_for(
+                lambda: not refreshes.unfinished_tasks, timeout
+            )
+            running = refreshes.unfinished_tasks
+        LOG.debug('%s stale versions still refreshing', running)
+        return running
+
 
 class PuppetModule:
-    """Base class for puppet modules"""
+    """Base class for puppet modules
+
+    Modules are immutable. Identity key, hash and string representation are
+    computed once on initialization.
+    """
 
-    def __init__(self, name):
+    __slots__ = ('_name', '_version', '_key', '_hash', '_repr', '__weakref__')
+
+    def __init__(self, name, version=None):
         """Initialize puppet module"""
         self._name = name
-        self._version = None
+        self._version = self._validate_version(version)
+        self._key = tuple(self.serialize())
+        self._hash = hash(self._key)
+        self._repr = self._representation()
+
+    @staticmethod
+    def _validate_version(version):
+        """returns version if it is supported by the module type"""
+        raise NotImplementedError
+
+    def _representation(self):
+        """returns unique string representation"""
+        return "%s" % self.name
 
     @staticmethod
     def parse_module_name(string):
@@ -78,18 +235,39 @@ class PuppetModule:
 
         # forge module
         if module_name.author is not None and 'url' not in module_info:
-            return ForgeModule(
+            return intern_module(ForgeModule(
                 author=module_name.author,
                 name=module_name.module,
                 version=module_info.get('version'),
-            )
+            ))
         # git module
         else:
-            return GitModule(
+            return intern_module(GitModule(
                 name=module_name.module,
                 url=module_info['url'],
                 version=module_info.get('version'),
+            ))
+
+    @classmethod
+    def deserialize(cls, data):
+        """returns a crmngr module object based on its serialized form"""
+        module = _INTERNED_MODULES.get(tuple(data))
+        if module is not None:
+            return module
+        source, name, location, version_type, version = data
+        if version_type is not None:
+            version = VERSION_TYPES[version_type](version)
+        if source == 'forge':
+            return intern_module(
+                ForgeModule(name=name, author=location, version=version)
             )
+        return intern_module(
+            GitModule(name=name, url=location, version=version)
+        )
+
+    def serialize(self):
+        """returns a compact, json serializable form of the module"""
+        raise NotImplementedError
 
     @property
     def name(self):
@@ -99,11 +277,15 @@ class PuppetModule:
     @property
     def version(self):
         """Return this modules version"""
-        raise NotImplementedError
+        return self._version
+
+    @property
+    def key(self):
+        """returns the identity key of this module"""
+        return self._key
 
-    @version.setter
-    def version(self, value):
-        """Set this modules version"""
+    def with_version(self, version):
+        """returns the shared instance of this module with another version"""
         raise NotImplementedError
 
     @property
@@ -119,13 +301,15 @@ class PuppetModule:
         return commit_message
 
     def __hash__(self):
-        return hash(self.__repr__())
+        return self._hash
 
     def __repr__(self):
-        return "%s" % self.name
+        return self._repr
 
     def __eq__(self, other):
-        return str(self) >= str(other) >= str(self)
+        if not isinstance(other, PuppetModule):
+            return NotImplemented
+        return self._key == other._key
 
     def __lt__(self, other):
         return str(other) > str(self)
@@ -134,37 +318,41 @@ class PuppetModule:
 class GitModule(PuppetModule):
     """Puppet mdoule hosted on git"""
 
+    __slots__ = ('_url', )
+
     def __init__(self, name, url, version=None):
         """Initialize git module
         :argument name Name of module
         :argument url Repository URL of module
         """
-        super().__init__(name)
         self._url = url
-        self.version = version
-
-    @property
-    def version(self):
-        """Return this modules version"""
-        return self._version
+        super().__init__(name, version)
 
-    @version.setter
-    def version(self, value):
-        """Set version of this puppet module"""
-        if isinstance(value, (GitBranch, GitCommit, GitRef, GitTag)):
-            self._version = value
-        else:
-            if value is None:
-                self._version = None
-            else:
-                raise TypeError('Unsupported type %s for value' % type(value))
+    @staticmethod
+    def _validate_version(version):
+        """returns version if it is supported by the module type"""
+        if version is None or isinstance(
+                version, (GitBranch, GitCommit, GitRef, GitTag)
+        ):
+            return version
+        raise TypeError('Unsupported type %s for value' % type(version))
+
+    def with_version(self, version):
+        """returns the shared instance of this module with another version"""
+        return intern_module(GitModule(self.name, self.url, version))
 
     @property
     def url(self):
         """URL to git repository for this puppet module"""
         return self._url
 
-    def __repr__(self):
+    def serialize(self):
+        """returns a compact, json serializable form of the module"""
+        if self.version is None:
+            return ['git', self.name, self.url, None, None]
+        return ['git', self.name, self.url] + self.version.serialize()
+
+    def _representation(self):
         """Return unique string representation"""
         representation = "%s:git:%s" % (self.name, self.url)
         if self.version:
@@ -186,12 +374,16 @@ class GitModule(PuppetModule):
             lines.append(self.version.puppetfile)
         return lines
 
-    def print_version_information(self, version_check=True, version_cache=None):
-        """Print out version information"""
-        if version_check:
-            latest_version = self.get_latest_version(version_cache)
-        else:
+    def print_version_information(self, version_check=True, version_cache=None,
+                                  latest_version=None):
+        """Print out version information
+
+        If latest_version is not specified, it is looked up.
+        """
+        if not version_check:
             latest_version = Unknown()
+        elif latest_version is None:
+            latest_version = self.get_latest_version(version_cache)
 
         cprint.magenta_bold('Version:', lpad=2)
         cprint.white('Git:', lpad=4, rpad=8, end='')
@@ -221,38 +413,56 @@ class GitModule(PuppetModule):
         else:
             cprint.white('')
 
-    def get_latest_version(self, version_cache=None):
-        """return a dict with version, date of newest tag in repository"""
-        if version_cache is not None:
+    def get_latest_version(self, version_cache=None, refresh=False):
+        """return a dict with version, date of newest tag in repository.
+
+        If refresh is True, the cache is not read but updated.
+        """
+        if version_cache is not None and not refresh:
             local_info = version_cache.read(self.cachename)
         else:
             local_info = {}
 
         if not local_info:
-            with Repository(self.url) as repository:
-                try:
-                    latest_tag = repository.latest_tag
-                except GitError:
-                    local_info = {}
-                else:
-                    local_info = {
-                        'version': latest_tag.name,
-                        'date': latest_tag.date.strftime('%Y-%m-%d'),
-                    }
-            if version_cache is not None:
+            try:
+                latest_tag = latest_remote_tag(self.url)
+            except GitError:
+                latest_tag = None
+            local_info = self.info_from_tag(latest_tag)
+            # a failed refresh keeps the stale entry
+            if version_cache is not None and (local_info or not refresh):
                 version_cache.write(self.cachename, local_info)
 
+        version = self.version_from_info(local_info)
+        LOG.debug("latest version for %s is %s", self.name, version)
+        return version
+
+    @staticmethod
+    def info_from_tag(latest_tag):
+        """returns dict with version and date for a (name, date) namedtuple
+        of the newest tag (or None)"""
+        if latest_tag is None:
+            return {}
+        local_info = {
+            'version': latest_tag.name,
+        }
+        if latest_tag.date is not None:
+            local_info['date'] = latest_tag.date.strftime('%Y-%m-%d')
+        return local_info
+
+    @staticmethod
+    def version_from_info(local_info):
+        """returns version object for a dict with version and date"""
         try:
-            version = GitTag(
+            return GitTag(
                 version=local_info['version'],
                 date=datetime.strptime(
                     local_info['date'], '%Y-%m-%d'
-                ).date()
+                ).date() if 'date' in local_info else None,
+                stale=local_info.get('stale', False),
             )
         except KeyError:
-            version = Unknown()  # pylint: disable=redefined-variable-type
-        LOG.debug("latest version for %s is %s", self.name, version)
-        return version
+            return Unknown()
 
     @property
     def cachename(self):
@@ -263,30 +473,26 @@ class GitModule(PuppetModule):
 class ForgeModule(PuppetModule):
     """Puppet module hosted on forge"""
 
+    __slots__ = ('_author', )
+
     def __init__(self, name, author, version=None):
         """Initialize forge module
         :argument name Name of module
         :argument author Author/Namespace of the module
         """
-        super().__init__(name)
         self._author = author
-        self.version = version
+        super().__init__(name, version)
 
-    @property
-    def version(self):
-        """Return this modules version"""
-        return self._version
+    @staticmethod
+    def _validate_version(version):
+        """returns version if it is supported by the module type"""
+        if version is None or isinstance(version, Forge):
+            return version
+        raise TypeError('Unsupported type %s for value' % type(version))
 
-    @version.setter
-    def version(self, value):
-        """Set version of this puppet module"""
-        if isinstance(value, Forge):
-            self._version = value
-        else:
-            if value is None:
-                self._version = None
-            else:
-                raise TypeError('Unsupported type %s for value' % type(value))
+    def with_version(self, version):
+        """returns the shared instance of this module with another version"""
+        return intern_module(ForgeModule(self.name, self.author, version))
 
     @property
     def author(self):
@@ -303,19 +509,29 @@ class ForgeModule(PuppetModule):
         """returns cache lookup key"""
         return hashlib.sha256(self.forgename.encode('utf-8')).hexdigest()
 
-    def __repr__(self):
+    def serialize(self):
+        """returns a compact, json serializable form of the module"""
+        if self.version is None:
+            return ['forge', self.name, self.author, None, None]
+        return ['forge', self.name, self.author] + self.version.serialize()
+
+    def _representation(self):
         """Return unique string representation"""
         representation = "%s:forge:%s" % (self.name, self.author)
         if self.version:
             representation += ":%s" % self.version
         return representation
 
-    def print_version_information(self, version_check=True, version_cache=None):
-        """Print out version information"""
-        if version_check:
-            latest_version = self.get_latest_version(version_cache)
-        else:
+    def print_version_information(self, version_check=True, version_cache=None,
+                                  latest_version=None):
+        """Print out version information
+
+        If latest_version is not specified, it is looked up.
+        """
+        if not version_check:
             latest_version = Unknown()
+        elif latest_version is None:
+            latest_version = self.get_latest_version(version_cache)
 
         cprint.magenta_bold('Version:', lpad=2)
         cprint.white('Forge:', lpad=4, rpad=6, end='')
@@ -333,9 +549,12 @@ class ForgeModule(PuppetModule):
         else:
             cprint.white('')
 
-    def get_latest_version(self, version_cache=None):
-        """returns dict with version and date of the newest version on forge"""
-        if version_cache is not None:
+    def get_latest_version(self, version_cache=None, refresh=False):
+        """returns dict with version and date of the newest version on forge.
+
+        If refresh is True, the cache is not read but updated.
+        """
+        if version_cache is not None and not refresh:
             local_info = version_cache.read(self.cachename)
         else:
             local_info = {}
@@ -352,12 +571,18 @@ class ForgeModule(PuppetModule):
             if version_cache is not None:
                 version_cache.write(self.cachename, local_info)
 
+        return self.version_from_info(local_info)
+
+    @staticmethod
+    def version_from_info(local_info):
+        """returns version object for a dict with version and date"""
         try:
             return Forge(
                 version=local_info['version'],
                 date=datetime.strptime(
                     local_info['date'], '%Y-%m-%d'
-                ).date()
+                ).date(),
+                stale=local_info.get('stale', False),
             )
         except KeyError:
             return Unknown()
@@ -372,21 +597,41 @@ class ForgeModule(PuppetModule):
 
 
 class BaseVersion:
-    """Base class for version objects"""
+    """Base class for version objects
 
-    def __init__(self, version, date=None):
+    Versions are equal if their serialized form (type and version) is equal,
+    independent of date and staleness.
+    """
+
+    __slots__ = ('_date', '_stale', '_version', '_key', '_hash')
+
+    def __init__(self, version, date=None, stale=False):
         """Initialize Version
         :argument version Version(-string) for this module.
+        :argument stale Whether or not version is read from an expired cache
+                        entry.
         """
         self._date = date
+        self._stale = stale
         self._version = version
+        self._key = tuple(self.serialize())
+        self._hash = hash(self._key)
 
     def __hash__(self):
-        return hash(self._version)
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, BaseVersion):
+            return NotImplemented
+        return self._key == other._key
 
     def __repr__(self):
         return "%s(%s)" % (type(self).__name__, str(self._version))
 
+    def serialize(self):
+        """returns a compact, json serializable form of the version"""
+        return [type(self).__name__, self._version]
+
     @property
     def version(self):
         """Return Version(-string)"""
@@ -397,13 +642,21 @@ class BaseVersion:
         """Return Date of Version"""
         return self._date
 
+    @property
+    def stale(self):
+        """Return whether or not Version is read from an expired cache entry"""
+        return self._stale
+
     @property
     def report(self):
         """Return version in suitable format for crmngr report"""
         if self._date is None:
-            return "%s" % self._version
+            report = "%s" % self._version
         else:
-            return "%s (%s)" % (self._version, self._date)
+            report = "%s (%s)" % (self._version, self._date)
+        if self._stale:
+            report += " [stale]"
+        return report
 
     @property
     def commit_message(self):
@@ -413,8 +666,11 @@ class BaseVersion:
 
 class Unknown(BaseVersion):
     """Object to represent and unknown Version"""
-    def __init__(self, version=None, date=None):
-        super().__init__(version, date)
+
+    __slots__ = ()
+
+    def __init__(self, version=None, date=None, stale=False):
+        super().__init__(version, date, stale)
 
     def __repr__(self):
         return "%s()" % type(self).__name__
@@ -428,6 +684,8 @@ class Unknown(BaseVersion):
 class Forge(BaseVersion):
     """Puppet Forge Version"""
 
+    __slots__ = ()
+
     @property
     def puppetfile(self):
         """Return version in suitable format for puppetfile"""
@@ -437,6 +695,8 @@ class Forge(BaseVersion):
 class GitBranch(BaseVersion):
     """Git Branch"""
 
+    __slots__ = ()
+
     @property
     def puppetfile(self):
         """Return version in suitable format for puppetfile"""
@@ -451,6 +711,8 @@ class GitBranch(BaseVersion):
 class GitCommit(BaseVersion):
     """Git Commit"""
 
+    __slots__ = ()
+
     @property
     def puppetfile(self):
         """Return version in suitable format for puppetfile"""
@@ -465,6 +727,8 @@ class GitCommit(BaseVersion):
 class GitRef(BaseVersion):
     """Git Ref"""
 
+    __slots__ = ()
+
     @property
     def puppetfile(self):
         """Return version in suitable format for puppetfile"""
@@ -474,6 +738,8 @@ class GitRef(BaseVersion):
 class GitTag(BaseVersion):
     """ Git Tag"""
 
+    __slots__ = ()
+
     @property
     def puppetfile(self):
         """Return version in suitable format for puppetfile"""
@@ -483,3 +749,9 @@ class GitTag(BaseVersion):
     def commit_message(self):
         """Return version in suitable format for commit message"""
         return "tag [%s]" % self.version
+
+
+VERSION_TYPES = {
+    version_type.__name__: version_type
+    for version_type in (Forge, GitBranch, GitCommit, GitRef, GitTag)
+}
@@ -0,0 +1,95 @@
+""" crmngr reportwriter module """
+
+# stdlib
+import csv
+import json
+
+
+class ReportWriter:
+    """base class for machine-readable report writers.
+
+    Records are written to the stream as soon as they are passed to write.
+    Every record is a dict with the keys listed in FIELDS.
+    """
+
+    FIELDS = [
+        'module',
+        'source',
+        'location',
+        'version_type',
+        'version',
+        'environments',
+        'missing_from',
+        'latest_version',
+        'latest_stale',
+        'up_to_date',
+    ]
+
+    def __init__(self, stream):
+        """initialize writer"""
+        self._stream = stream
+
+    def write(self, record):
+        """write a single record"""
+        raise NotImplementedError
+
+    def close(self):
+        """finish the report"""
+        self._stream.flush()
+
+
+class CsvWriter(ReportWriter):
+    """writes records as CSV with a header line.
+
+    Environment lists are space separated.
+    """
+
+    def __init__(self, stream):
+        """initialize writer"""
+        super().__init__(stream)
+        self._writer = csv.DictWriter(stream, fieldnames=self.FIELDS)
+        self._writer.writeheader()
+
+    def write(self, record):
+        """write a single record"""
+        self._writer.writerow(dict(
+            record,
+            environments=' '.join(record['environments']),
+            missing_from=' '.join(record['missing_from']),
+        ))
+
+
+class JsonLinesWriter(ReportWriter):
+    """writes every record as JSON object on a separate line"""
+
+    def write(self, record):
+        """write a single record"""
+        self._stream.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class JsonWriter(ReportWriter):
+    """writes all records as a single JSON array"""
+
+    def __init__(self, stream):
+        """initialize writer"""
+        super().__init__(stream)
+        self._separator = '[\n'
+
+    def write(self, record):
+        """write a single record"""
+        self._stream.write(self._separator + json.dumps(record, sort_keys=True))
+        self._separator = ',\n'
+
+    def close(self):
+        """finish the report"""
+        if self._separator == '[\n':
+            self._stream.write('[')
+        self._stream.write('\n]\n')
+        super().close()
+
+
+REPORT_WRITERS = {
+    'csv': CsvWriter,
+    'json': JsonWriter,
+    'jsonl': JsonLinesWriter,
+}
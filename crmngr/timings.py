@@ -0,0 +1,98 @@
+""" crmngr timings module """
+
+# stdlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import logging
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+
+class Timings:
+    """records wall time and count of instrumented operations.
+
+    Operations are grouped by category (phase, git, forge, cache) and name.
+    Recording is disabled by default and needs to be enabled explicitly.
+    """
+
+    def __init__(self):
+        """initialize timings"""
+        self._lock = threading.Lock()
+        self._records = OrderedDict()
+        self._start = time.perf_counter()
+        self.enabled = False
+
+    def enable(self):
+        """enable recording and reset all records"""
+        with self._lock:
+            self._records = OrderedDict()
+            self._start = time.perf_counter()
+            self.enabled = True
+
+    def _record(self, category, name, duration):
+        """add a single operation to the records"""
+        with self._lock:
+            record = self._records.setdefault(
+                (category, name), {'count': 0, 'total': 0.0, 'max': 0.0}
+            )
+            record['count'] += 1
+            record['total'] += duration
+            record['max'] = max(record['max'], duration)
+
+    @contextmanager
+    def measure(self, category, name):
+        """measure wall time of the operation executed in the context"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(category, name, time.perf_counter() - start)
+
+    def count(self, category, name):
+        """count an operation without measuring its duration"""
+        if self.enabled:
+            self._record(category, name, 0.0)
+
+    @property
+    def summary(self):
+        """returns a list of dicts with all records"""
+        with self._lock:
+            return [
+                dict(record, category=category, name=name)
+                for (category, name), record in self._records.items()
+            ]
+
+    def write_table(self, stream):
+        """write summary as table to stream"""
+        stream.write('{:<8} {:<40} {:>7} {:>10} {:>10}\n'.format(
+            'category', 'name', 'count', 'total', 'max'
+        ))
+        for record in sorted(self.summary,
+                             key=lambda record: (record['category'],
+                                                 -record['total'])):
+            stream.write('{:<8} {:<40} {:>7} {:>9.3f}s {:>9.3f}s\n'.format(
+                record['category'], record['name'][:40], record['count'],
+                record['total'], record['max'],
+            ))
+        stream.write('{:<8} {:<40} {:>7} {:>9.3f}s\n'.format(
+            'total', 'wall time', '', time.perf_counter() - self._start
+        ))
+
+    def write_json(self, stream):
+        """write summary as json to stream"""
+        json.dump({
+            'wall_time': time.perf_counter() - self._start,
+            'timings': self.summary,
+        }, stream, indent=2)
+        stream.write('\n')
+
+
+TIMINGS = Timings()
+measure = TIMINGS.measure  # pylint: disable=invalid-name
+count = TIMINGS.count  # pylint: disable=invalid-name
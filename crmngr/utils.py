@@ -4,6 +4,9 @@
 from fnmatch import fnmatchcase
 import sys
 
+# crmngr
+from crmngr import cprint
+
 
 def truncate(string, max_len=1000):
     """returns a truncated to max_len version of a string (or str(string))"""
@@ -37,6 +40,8 @@ def query_yes_no(question, default="yes"):
     else:
         raise ValueError("invalid default answer: '%s'" % default)
 
+    # buffered output has to be visible before waiting for input
+    cprint.flush()
     while True:
         sys.stdout.write(question + prompt)
         choice = input().lower()
@@ -36,7 +36,7 @@ setup(
     },
     install_requires=[
         'natsort>=4.0.0',
-        'requests>=2.1.0',
+        'requests>=2.4.0',
     ],
     setup_requires=[
         'pytest-runner',
@@ -44,7 +44,7 @@ setup(
     tests_require=[
         'pytest',
     ],
-    python_requires='>=3.4',
+    python_requires='>=3.8',
     # BSD 3-Clause License:
     # - http://opensource.org/licenses/BSD-3-Clause
     license='BSD',
@@ -1,15 +1,51 @@
+import io
+import json
+import os
 import subprocess
+import sys
+import threading
+import time
+from argparse import Namespace
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
 import pytest
 
 from crmngr import ControlRepository
+from crmngr import cprint
+from crmngr import daemon
+from crmngr import timings
+from crmngr.cache import JsonCache
+from crmngr.controlrepository import ModuleIndex
+from crmngr.cache import SqliteCache
+from crmngr.exceptions import NoEnvironmentError
+from crmngr.forgeapi import ForgeApi
+from crmngr.forgeapi import ForgeError
+from crmngr.git import check_git_version
+from crmngr.git import GitError
+from crmngr.git import MirrorStore
+from crmngr.git import mirror_lock
+from crmngr.git import RemoteRepository
+from crmngr.git import Repository
+from crmngr.git import latest_remote_tag
+from crmngr.git import latest_remote_tags
+from crmngr.git import remote_host
+from crmngr.git import tag_version_key
+from crmngr.git import remote_branches
+from crmngr.puppetfile import Forge
+from crmngr.puppetfile import ForgeModule
+from crmngr.puppetfile import GitModule
 from crmngr.puppetfile import GitTag
+from crmngr.puppetfile import LatestVersions
 
 
 @pytest.fixture()
-def control_repo():
+def control_repo_url():
     git_dir = TemporaryDirectory(prefix='crmngr_test_')
     bare_dir = Path(git_dir.name, 'bare')
     work_dir = Path(git_dir.name, 'work')
@@ -41,10 +77,110 @@ def control_repo():
     subprocess.run(['git', 'add', str(Path(work_dir, 'Puppetfile'))], cwd=str(work_dir))
     subprocess.run(['git', 'commit', '-m', 'Initial commit', 'Puppetfile'], cwd=str(work_dir))
     subprocess.run(['git', 'push', 'origin', 'staging'], cwd=str(work_dir))
-    yield ControlRepository(clone_url="file://{}".format(bare_dir))
+    yield "file://{}".format(bare_dir)
     git_dir.cleanup()
 
 
+@pytest.fixture()
+def module_repo_url(tmp_path):
+    work_dir = str(Path(str(tmp_path), 'module'))
+    subprocess.run(['git', 'init', work_dir])
+    for tag in ['1.2.0', '1.10.0', '1.9.0']:
+        subprocess.run(['git', 'commit', '--allow-empty', '-m', tag],
+                       cwd=work_dir)
+        subprocess.run(['git', 'tag', '-a', '-m', tag, tag], cwd=work_dir)
+    yield "file://{}".format(work_dir)
+
+
+@pytest.fixture()
+def compare_repo(tmp_path):
+    bare_dir = str(tmp_path / 'compare.git')
+    work_dir = str(tmp_path / 'compare')
+    subprocess.run(['git', 'init', '--bare', bare_dir])
+    subprocess.run(['git', 'init', work_dir])
+    environments = {
+        'production': {'concat': '4.0.0', 'firewall': '1.10.0',
+                       'stdlib': '4.20.0'},
+        'staging': {'concat': '4.0.0', 'firewall': '1.10.0',
+                    'stdlib': '4.23.0'},
+        'development': {'concat': '4.0.0', 'stdlib': '4.23.0'},
+    }
+    for branch, modules in environments.items():
+        subprocess.run(['git', 'checkout', '--orphan', branch], cwd=work_dir)
+        with open(str(Path(work_dir, 'Puppetfile')), 'w') as puppetfile:
+            puppetfile.write("\n".join(
+                ["forge 'http://forge.puppetlabs.com'", ""] + [
+                    "mod 'puppetlabs/%s', '%s'" % module
+                    for module in sorted(modules.items())
+                ] + [""]
+            ))
+        subprocess.run(['git', 'add', 'Puppetfile'], cwd=work_dir)
+        subprocess.run(['git', 'commit', '-m', branch], cwd=work_dir)
+        subprocess.run(['git', 'push', bare_dir, branch], cwd=work_dir)
+    yield ControlRepository(clone_url='file://%s' % bare_dir)
+
+
+@pytest.fixture()
+def control_repo(control_repo_url):
+    yield ControlRepository(clone_url=control_repo_url)
+
+
+class ForgeHandler(BaseHTTPRequestHandler):
+    """stand-in for the puppet forge v3 modules api"""
+
+    protocol_version = 'HTTP/1.1'
+
+    @staticmethod
+    def module_info(slug):
+        return {
+            'slug': slug,
+            'current_release': {
+                'version': '9.9.9',
+                'updated_at': '2018-01-18 12:00:00 +0000',
+            },
+            'releases': [{'version': '9.9.9'}],
+        }
+
+    @classmethod
+    def respond(cls, url):
+        if url.path == '/v3/modules':
+            slugs = parse_qs(url.query).get('slugs', [''])[0].split(',')
+            return 200, {
+                'pagination': {'next': None},
+                'results': [cls.module_info(slug) for slug in slugs if slug],
+            }
+        return 200, cls.module_info(url.path.rsplit('/', 1)[-1])
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address[1], self.path))
+        status, response = self.server.respond(urlparse(self.path))
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture()
+def forge_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ForgeHandler)
+    server.requests = []
+    server.respond = ForgeHandler.respond
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    settings = ForgeApi._settings
+    ForgeApi.configure(url='http://127.0.0.1:%d' % server.server_port,
+                       backoff_factor=0)
+    yield server
+    ForgeApi.configure(**settings)
+    server.shutdown()
+    server.server_close()
+
+
 class TestCrmngr:
 
     def test_environments(self, control_repo):
@@ -57,3 +193,554 @@ class TestCrmngr:
     def test_stdlib_production(self, control_repo):
         production = control_repo.get_environment('production')
         assert str(production['firewall']) == 'firewall:git:https://github.com/puppetlabs/puppetlabs-firewall.git:GitTag(1.11.0)'
+
+    def test_interned_modules(self, control_repo):
+        production = control_repo.get_environment('production')
+        staging = control_repo.get_environment('staging')
+        assert production['stdlib'] is not staging['stdlib']
+        stdlib = staging['stdlib'].with_version(Forge('4.20.0'))
+        assert stdlib is production['stdlib']
+        assert ForgeModule('stdlib', 'puppetlabs', Forge('4.20.0')) == stdlib
+        with pytest.raises(AttributeError):
+            stdlib.version = Forge('4.21.0')
+
+    def test_version_equality(self):
+        assert Forge('4.20.0') == Forge('4.20.0', stale=True)
+        assert hash(Forge('4.20.0')) == hash(Forge('4.20.0', stale=True))
+        assert Forge('4.20.0') != GitTag('4.20.0')
+        assert Forge('4.20.0') != Forge('4.21.0')
+        # versions from different environments share a mask
+        index = ModuleIndex()
+        index.add('production', 'stdlib', Forge('4.20.0'))
+        index.add('staging', 'stdlib', Forge('4.20.0'))
+        index.add('staging', 'stdlib', GitTag('4.20.0'))
+        assert index['stdlib'] == {Forge('4.20.0'): {'production', 'staging'},
+                                   GitTag('4.20.0'): {'staging'}}
+
+    def test_module_index(self, control_repo):
+        assert control_repo.modules.environments('stdlib') == {'production', 'staging'}
+        assert control_repo.modules.modules('staging') == {'firewall', 'stdlib'}
+        staging = control_repo.get_environment('staging')
+        staging['stdlib'] = ForgeModule('stdlib', 'puppetlabs', Forge('4.20.0'))
+        assert [str(version) for version in control_repo.modules.versions('stdlib')] == ['stdlib:forge:puppetlabs:Forge(4.20.0)']
+        del staging['firewall']
+        assert control_repo.modules.environments('firewall') == {'production'}
+        assert control_repo.modules.modules('staging') == {'stdlib'}
+
+    def test_mirror(self, control_repo_url, tmp_path):
+        mirror_dir = str(Path(str(tmp_path), 'mirror'))
+        ControlRepository(clone_url=control_repo_url, mirror_dir=mirror_dir)
+        control_repo = ControlRepository(clone_url=control_repo_url,
+                                         mirror_dir=mirror_dir)
+        assert sorted(control_repo.branches) == ['production', 'staging']
+        staging = control_repo.get_environment('staging')
+        assert str(staging['stdlib']) == 'stdlib:forge:puppetlabs:Forge(4.23.0)'
+
+    def test_fetch_matching_environments(self, control_repo_url, tmp_path):
+        control_repo = ControlRepository(clone_url=control_repo_url,
+                                         environments=['!', 'stag*'])
+        assert list(control_repo.branches) == ['production']
+        mirror_dir = str(Path(str(tmp_path), 'mirror'))
+        control_repo = ControlRepository(clone_url=control_repo_url,
+                                         environments=['stag*'],
+                                         mirror_dir=mirror_dir)
+        assert list(control_repo.branches) == ['staging']
+        assert control_repo.environment_names == {'staging'}
+        for environments in (['typo'], ['!', '*']):
+            with pytest.raises(NoEnvironmentError):
+                ControlRepository(clone_url=control_repo_url,
+                                  environments=environments)
+
+    def test_partial_clone(self, control_repo_url, tmp_path):
+        subprocess.run(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                       cwd=control_repo_url[len('file://'):])
+        mirror_dir = str(Path(str(tmp_path), 'mirror'))
+        for kwargs in ({}, {'mirror_dir': mirror_dir},
+                       {'environments': ['staging']}):
+            control_repo = ControlRepository(clone_url=control_repo_url,
+                                             partial=True, **kwargs)
+            assert control_repo.git(
+                ['config', 'remote.origin.promisor']
+            ).strip() == 'true'
+            staging = control_repo.get_environment('staging')
+            assert str(staging['stdlib']) == 'stdlib:forge:puppetlabs:Forge(4.23.0)'
+        # resolving object names does not fetch the omitted blobs
+        with Repository(control_repo_url, partial=True) as repository:
+            names = repository.object_names(
+                ['refs/remotes/origin/%s:Puppetfile' % branch
+                 for branch in repository.branches] +
+                ['refs/remotes/origin/staging:missing']
+            )
+            assert len(names) == 2
+            missing = repository.git(
+                ['rev-list', '--objects', '--all', '--missing=print']
+            ).split()
+            assert sorted('?%s' % sha for sha in names.values()) == sorted(
+                name for name in missing if name.startswith('?'))
+
+    def test_git_version(self, control_repo_url, monkeypatch):
+        check_git_version()
+        monkeypatch.setattr('crmngr.git._GIT_VERSION', (2, 19, 0))
+        with pytest.raises(GitError):
+            check_git_version()
+        # without fetch --stdin, omitted blobs are passed as arguments
+        monkeypatch.setattr('crmngr.git._GIT_VERSION', (2, 20, 0))
+        subprocess.run(['git', 'config', 'uploadpack.allowFilter', 'true'],
+                       cwd=control_repo_url[len('file://'):])
+        control_repo = ControlRepository(clone_url=control_repo_url,
+                                         partial=True)
+        staging = control_repo.get_environment('staging')
+        assert str(staging['stdlib']) == 'stdlib:forge:puppetlabs:Forge(4.23.0)'
+
+    def test_remote_branches(self, control_repo_url):
+        assert [branch.name for branch in remote_branches(control_repo_url)] == ['production', 'staging']
+        branches = remote_branches(control_repo_url, details=True)
+        assert [branch.name for branch in branches] == ['production', 'staging']
+        assert all(branch.date is not None and branch.author for branch in branches)
+
+    def test_new_environment(self, control_repo_url, tmp_path):
+        for kwargs in ({}, {'mirror_dir': str(Path(str(tmp_path), 'mirror'))}):
+            control_repo = ControlRepository(clone_url=control_repo_url,
+                                             environments=[], **kwargs)
+            assert control_repo.environments == []
+            name = 'new%s' % len(kwargs)
+            control_repo.new_environment(name)
+            assert control_repo.environment_names == {name}
+            assert name in [branch.name for branch in remote_branches(control_repo_url)]
+
+    def test_renderer(self, capsys):
+        cprint.white('Used by:', lpad=4, rpad=4, end='')
+        cprint.cyan('production')
+        cprint.flush()
+        assert capsys.readouterr().out == '    Used by:    production\n'
+
+    @pytest.mark.parametrize('isatty,no_color,colored', [
+        (True, None, True),
+        (True, '1', False),
+        (False, None, False),
+    ])
+    def test_renderer_colors(self, monkeypatch, isatty, no_color, colored):
+        class Stream(io.StringIO):
+            def isatty(self):
+                return isatty
+
+        if no_color is None:
+            monkeypatch.delenv('NO_COLOR', raising=False)
+        else:
+            monkeypatch.setenv('NO_COLOR', no_color)
+        stream = Stream()
+        renderer = cprint.Renderer()
+        with redirect_stdout(stream):
+            renderer.write(cprint.TERM_CYAN, 'production', lpad=4)
+            renderer.flush()
+        if colored:
+            assert stream.getvalue() == '    %sproduction%s\n' % (
+                cprint.TERM_CYAN, cprint.TERM_NONE)
+        else:
+            assert stream.getvalue() == '    production\n'
+            assert '\033' not in stream.getvalue()
+
+    def test_report_jsonl(self, control_repo, capsys):
+        control_repo.report(version_check=False, output_format='jsonl')
+        records = [json.loads(line)
+                   for line in capsys.readouterr().out.splitlines()]
+        assert [(record['module'], record['version'], record['environments'])
+                for record in records] == [
+            ('firewall', '1.11.0', ['production']),
+            ('firewall', '1.10.0', ['staging']),
+            ('stdlib', '4.23.0', ['staging']),
+            ('stdlib', '4.20.0', ['production']),
+        ]
+        assert records[0]['latest_version'] is None
+
+    def test_report_compare(self, compare_repo, capsys):
+        compare_repo.report(compare=False, version_check=False)
+        assert 'Module: concat' in capsys.readouterr().out
+        compare_repo.report(compare=True, version_check=False)
+        output = capsys.readouterr().out
+        # concat is identical in all environments
+        assert 'Module: concat' not in output
+        firewall = output[output.index('Module: firewall'):
+                          output.index('Module: stdlib')]
+        assert firewall.split('Missing from:')[1].split() == ['development']
+        assert 'Missing from:' not in output[output.index('Module: stdlib'):]
+
+        compare_repo.report(compare=True, version_check=False,
+                            output_format='jsonl')
+        records = [json.loads(line)
+                   for line in capsys.readouterr().out.splitlines()]
+        assert [(record['module'], record['version'], record['missing_from'])
+                for record in records] == [
+            ('firewall', '1.10.0', ['development']),
+            ('stdlib', '4.23.0', []),
+            ('stdlib', '4.20.0', []),
+        ]
+
+    def test_daemon(self, control_repo, tmp_path):
+        def report(repo, args):
+            repo.select(args.environments).report(
+                compare=False, version_check=False, output_format='jsonl')
+
+        crmngr_daemon = daemon.Daemon(
+            socket_path=str(tmp_path / 'serve.sock'),
+            load=lambda: control_repo,
+            handlers={'report': report},
+        )
+        threading.Thread(target=crmngr_daemon.serve, daemon=True).start()
+        deadline = time.monotonic() + 30
+        while daemon.query(crmngr_daemon._socket_path, 'ping') is None:
+            assert time.monotonic() < deadline, 'daemon did not start'
+            time.sleep(0.05)
+        output = io.StringIO()
+        assert daemon.query(crmngr_daemon._socket_path, 'report',
+                            vars(Namespace(environments=['staging'])),
+                            stream=output) == 0
+        assert [json.loads(line)['version']
+                for line in output.getvalue().splitlines()] == [
+            '1.10.0', '4.23.0']
+        assert daemon.query(crmngr_daemon._socket_path, 'update',
+                            stream=io.StringIO()) == 1
+
+    def test_resolve_latest_versions(self):
+        class Module:
+            lookups = []
+
+            def __init__(self, cachename):
+                self.cachename = cachename
+
+            def get_latest_version(self, version_cache=None):
+                self.lookups.append(self.cachename)
+                return GitTag(self.cachename)
+
+        latest_versions = ControlRepository.resolve_latest_versions(
+            [Module('a'), Module('b'), Module('a')], jobs=2
+        )
+        assert sorted(Module.lookups) == ['a', 'b']
+        assert latest_versions['a'].version == 'a'
+
+    def test_forge_bulk(self, forge_server, monkeypatch):
+        monkeypatch.setattr(ForgeApi, 'BATCH_SIZE', 2)
+        versions = ForgeApi.current_versions(
+            ['puppetlabs/stdlib', 'puppetlabs/Firewall', 'puppetlabs/apt'])
+        assert versions == {
+            forgename: {'version': '9.9.9', 'date': '2018-01-18'}
+            for forgename in ('puppetlabs/stdlib', 'puppetlabs/Firewall',
+                              'puppetlabs/apt')
+        }
+        assert [parse_qs(urlparse(path).query)['slugs']
+                for _, path in forge_server.requests] == [
+            ['puppetlabs-apt,puppetlabs-firewall'], ['puppetlabs-stdlib']]
+        # requests share a pooled keep-alive connection
+        assert len({port for port, _ in forge_server.requests}) == 1
+
+    def test_forge_bulk_resolve(self, forge_server):
+        modules = [ForgeModule('stdlib', 'puppetlabs', Forge('4.20.0')),
+                   ForgeModule('apt', 'puppetlabs', Forge('1.0.0'))]
+        latest_versions = ControlRepository.resolve_latest_versions(modules)
+        assert [latest_versions[module.cachename].version
+                for module in modules] == ['9.9.9', '9.9.9']
+        assert len(forge_server.requests) == 1
+
+    def test_forge_retry(self, forge_server):
+        def respond(url):
+            if len(forge_server.requests) == 1:
+                return 503, {}
+            return ForgeHandler.respond(url)
+        forge_server.respond = respond
+        api = ForgeApi(name='stdlib', author='puppetlabs')
+        assert api.current_version == {'version': '9.9.9',
+                                       'date': '2018-01-18'}
+        assert len(forge_server.requests) == 2
+
+    @pytest.mark.parametrize('next_page', [
+        lambda page: '/v3/modules?offset=1',
+        lambda page: '/v3/modules?offset=%s' % page,
+    ])
+    def test_forge_pagination(self, forge_server, next_page):
+        def respond(url):
+            return 200, {
+                'pagination': {'next': next_page(len(forge_server.requests))},
+                'results': [],
+            }
+        forge_server.respond = respond
+        with pytest.raises(ForgeError):
+            ForgeApi.current_versions(['puppetlabs/stdlib'])
+        assert len(forge_server.requests) <= ForgeApi.MAX_PAGES
+
+    def test_latest_versions(self, tmp_path):
+        lookups = []
+        started = threading.Event()
+        release = threading.Event()
+
+        class Module:
+            cachename = 'a'
+
+            def get_latest_version(self, version_cache=None):
+                lookups.append(version_cache)
+                started.set()
+                release.wait(5)
+                return GitTag('1.0.0')
+
+        cache = SqliteCache(str(tmp_path))
+        latest_versions = LatestVersions(cache)
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(latest_versions.get(Module()))
+        ) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert lookups == [cache]
+        assert len(results) == 4 and len(set(map(id, results))) == 1
+        ControlRepository.resolve_latest_versions(
+            [Module()], latest_versions=latest_versions
+        )
+        assert lookups == [cache]
+
+    def test_latest_remote_tag(self, module_repo_url):
+        latest_tag = latest_remote_tag(module_repo_url)
+        assert latest_tag.name == '1.10.0'
+        assert latest_tag.date is not None
+
+    def test_tag_version_key(self, module_repo_url):
+        tags = ['1.10.0', 'latest', 'v1.9.1', '1.10.0-rc1', '1.10.0-rc10',
+                '1.10.0-rc2', 'v1.11', '1.2.0']
+        assert sorted(tags, key=tag_version_key) == [
+            'latest', '1.2.0', 'v1.9.1', '1.10.0-rc1', '1.10.0-rc2',
+            '1.10.0-rc10', '1.10.0', 'v1.11',
+        ]
+        work_dir = module_repo_url[len('file://'):]
+        for tag in ['1.10.0-rc1', 'v1.9.1']:
+            subprocess.run(['git', 'tag', tag], cwd=work_dir)
+        assert latest_remote_tag(module_repo_url).name == '1.10.0'
+        assert Repository(module_repo_url, mirror_dir=str(
+            Path(work_dir).parent / 'mirror')).latest_tag.name == '1.10.0'
+
+    def test_lazy_imports(self):
+        modules = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, crmngr; print(" ".join(sys.modules))',
+        ], universal_newlines=True).split()
+        for module in ('crmngr.controlrepository', 'natsort', 'requests'):
+            assert module not in modules
+
+    def test_lightweight_command(self, tmp_path):
+        (tmp_path / '.crmngr').mkdir()
+        (tmp_path / '.crmngr' / 'profiles').write_text(
+            '[default]\nrepository = file:///nonexistent\n')
+        # commands exiting early do not import the control repository
+        process = subprocess.run([
+            sys.executable, '-c',
+            'import sys, crmngr\n'
+            'crmngr.command_profiles = lambda **kwargs: sys.exit(3)\n'
+            'sys.argv = ["crmngr", "profiles"]\n'
+            'try:\n'
+            '    crmngr.main()\n'
+            'finally:\n'
+            '    print(" ".join(sys.modules))',
+        ], env=dict(os.environ, HOME=str(tmp_path)), stdout=subprocess.PIPE,
+            universal_newlines=True)
+        assert process.returncode == 3
+        assert 'crmngr.controlrepository' not in process.stdout.split()
+
+    def test_profile_timings(self, control_repo_url, tmp_path):
+        (tmp_path / '.crmngr').mkdir()
+        (tmp_path / '.crmngr' / 'profiles').write_text(
+            '[default]\nrepository = %s\n' % control_repo_url)
+        timings_file = tmp_path / 'timings.json'
+        process = subprocess.run([
+            sys.executable, '-c', 'import crmngr; crmngr.main()',
+            '--profile-timings', '--profile-timings-json', str(timings_file),
+            'report', '--no-version-check', '--format', 'jsonl',
+        ], env=dict(os.environ, HOME=str(tmp_path)), stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        assert process.returncode == 0
+        assert len(process.stdout.splitlines()) == 4
+        table = process.stderr.splitlines()
+        assert table[0].split() == ['category', 'name', 'count', 'total',
+                                    'max']
+        assert table[-1].split()[:3] == ['total', 'wall', 'time']
+        report = json.loads(timings_file.read_text())
+        assert report['wall_time'] > 0
+        records = {(record['category'], record['name']): record
+                   for record in report['timings']}
+        assert records[('parse', 'miss')]['count'] == 2
+        assert ('phase', 'parse') in records
+        assert any(category == 'git' for category, _ in records)
+        # every record shows up as row of the table
+        rows = {tuple(row.split()[:2]) for row in table[1:-1]}
+        assert rows == {(category, name.split()[0])
+                        for category, name in records}
+        for record in report['timings']:
+            assert record['count'] >= 1
+            assert 0 <= record['max'] <= record['total']
+
+    def test_mirror_store(self, module_repo_url, tmp_path):
+        store = MirrorStore(str(tmp_path / 'mirrors'), max_size=0)
+        mirrors = tmp_path / 'mirrors'
+        with store.repository('a', module_repo_url) as repository:
+            repository.validate_tag('1.9.0')
+            assert repository.latest_tag.name == '1.10.0'
+            # mirrors in use are not removed
+            store.repository('b', module_repo_url).cleanup()
+            assert sorted(path.name for path in mirrors.iterdir()
+                          if path.is_dir()) == ['a', 'b']
+            # the update lock is only held while updating the mirror
+            with mirror_lock(str(mirrors / 'a'), blocking=False) as locked:
+                assert locked
+        # all but the most recently used mirror exceed max_size
+        store.repository('c', module_repo_url).cleanup()
+        assert sorted(path.name for path in mirrors.iterdir()
+                      if path.is_dir()) == ['c']
+        # mirrors locked by another run are not removed
+        with mirror_lock(str(mirrors / 'c'), shared=True, kind='use'):
+            with mirror_lock(str(mirrors / 'c'), blocking=False,
+                             kind='use') as locked:
+                assert not locked
+            store.evict()
+        assert (mirrors / 'c').is_dir()
+
+    def test_batch_reads(self, control_repo):
+        branches = {branch.name: branch for branch in control_repo.branch_details()}
+        assert sorted(branches) == ['production', 'staging']
+        names = control_repo.object_names(['refs/remotes/origin/staging', 'refs/remotes/origin/staging:missing'])
+        assert names == {'refs/remotes/origin/staging': branches['staging'].sha}
+        control_repo.validate_commit(branches['staging'].sha[:10])
+        with pytest.raises(GitError):
+            control_repo.validate_commit('refs/remotes/origin/staging:Puppetfile')
+
+    def test_remote_repository(self, module_repo_url):
+        repository = RemoteRepository(module_repo_url)
+        repository.validate_tag('1.10.0')
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '1.9.0^{commit}'],
+            cwd=module_repo_url[len('file://'):], universal_newlines=True,
+        ).strip()
+        repository.validate_commit(commit)
+        for validate, ref in ((repository.validate_tag, '1.10'),
+                              (repository.validate_branch, '1.10.0'),
+                              (repository.validate_commit, commit[:7])):
+            with pytest.raises(GitError):
+                validate(ref)
+
+    def test_latest_remote_tags(self, module_repo_url, tmp_path):
+        assert remote_host('https://git.example.com/a/b.git') == 'git.example.com'
+        assert remote_host('git@git.example.com:a/b.git') == 'git.example.com'
+        assert remote_host(module_repo_url) is None
+        missing = 'file://%s' % (tmp_path / 'missing')
+        latest_tags = latest_remote_tags([module_repo_url, missing])
+        assert latest_tags[module_repo_url].name == '1.10.0'
+        assert latest_tags[missing] is None
+
+    def test_sqlite_cache(self, tmp_path):
+        cache = SqliteCache(str(tmp_path), ttl=60)
+        cache.write('a', {'version': '1.0.0'})
+        cache.write_many({'b': {'version': '2.0.0'}, 'c': {}})
+        assert cache.read('a')['version'] == '1.0.0'
+        assert cache.read('missing') == {}
+        entries = cache.read_many(['a', 'b', 'missing'])
+        assert entries['b']['version'] == '2.0.0'
+        assert entries['missing'] == {}
+        assert cache.read('a', ttl=-1) == {}
+        assert cache.keys() == ['a', 'b', 'c']
+        assert cache.expire(ttl=-1, prefix='b') == 1
+        assert cache.expire(ttl=-1) == 2
+        assert cache.keys() == []
+
+    @pytest.mark.parametrize('backend', [JsonCache, SqliteCache])
+    def test_stale_while_revalidate(self, backend, module_repo_url, tmp_path):
+        module = GitModule('firewall', module_repo_url)
+        backend(str(tmp_path)).write(module.cachename, {'version': '1.9.0'})
+        # every entry is expired, but within max_stale
+        cache = backend(str(tmp_path), ttl=-1, max_stale=60)
+        latest_versions = LatestVersions(cache)
+        latest_version = latest_versions.get(module)
+        assert latest_version.report == '1.9.0 [stale]'
+        assert latest_versions.wait(timeout=30) == 0
+        assert cache.read(module.cachename, ttl=60)['version'] == '1.10.0'
+        assert backend(str(tmp_path), ttl=-1).read(module.cachename) == {}
+
+    def test_refresh_workers(self):
+        refreshed = []
+        release = threading.Event()
+
+        class Module:
+            def __init__(self, cachename):
+                self.cachename = cachename
+
+            def get_latest_version(self, version_cache=None, refresh=False):
+                release.wait(5)
+                refreshed.append(self.cachename)
+
+        latest_versions = LatestVersions()
+        for name in range(20):
+            latest_versions.set(Module(str(name)),
+                                GitTag('1.0.0', stale=True))
+        workers = list(latest_versions._refresh_workers)
+        assert len(workers) == LatestVersions.REFRESH_WORKERS
+        assert latest_versions.wait(timeout=0.1) > 0
+        release.set()
+        assert latest_versions.wait(timeout=30) == 0
+        assert sorted(refreshed, key=int) == [str(name) for name in range(20)]
+        # idle workers exit
+        for worker in workers:
+            worker.join(5)
+            assert not worker.is_alive()
+
+    def test_resolve_stale_versions(self, module_repo_url, tmp_path):
+        module = GitModule('firewall', module_repo_url)
+        SqliteCache(str(tmp_path)).write(module.cachename, {'version': '1.9.0'})
+        cache = SqliteCache(str(tmp_path), ttl=-1, max_stale=60)
+        reads = []
+        read_many = cache.read_many
+        cache.read_many = lambda keys, **kwargs: reads.append(list(keys)) or \
+            read_many(reads[-1], **kwargs)
+        latest_versions = LatestVersions(cache)
+        resolved = ControlRepository.resolve_latest_versions(
+            [module], latest_versions=latest_versions)
+        assert resolved[module.cachename].report == '1.9.0 [stale]'
+        assert reads == [[module.cachename]]
+        assert latest_versions.wait(timeout=30) == 0
+        assert cache.read(module.cachename, ttl=60)['version'] == '1.10.0'
+
+    def test_parse_cache(self, control_repo_url, tmp_path):
+        cache = SqliteCache(str(tmp_path))
+        ControlRepository(clone_url=control_repo_url, parse_cache=cache)
+        assert len(cache.keys()) == 2
+        control_repo = ControlRepository(clone_url=control_repo_url,
+                                         parse_cache=cache)
+        production = control_repo.get_environment('production')
+        assert str(production['firewall']) == 'firewall:git:https://github.com/puppetlabs/puppetlabs-firewall.git:GitTag(1.11.0)'
+
+    def test_parse_cache_expiry(self, control_repo_url, tmp_path):
+        cache = JsonCache(str(tmp_path))
+        for key in ('puppetfile-0123', 'version'):
+            cache.write(key, {'modules': []})
+            os.utime(str(tmp_path / key), (0, 0))
+        timings.TIMINGS.enable()
+        try:
+            ControlRepository(clone_url=control_repo_url, parse_cache=cache)
+            categories = {(record['category'], record['name'])
+                          for record in timings.TIMINGS.summary}
+        finally:
+            timings.TIMINGS.enabled = False
+        assert sorted(path.name[:len('puppetfile-v1-')]
+                      for path in tmp_path.iterdir()) == [
+            'puppetfile-v1-', 'puppetfile-v1-', 'version']
+        assert ('parse', 'miss') in categories
+        assert not any(category == 'cache' for category, _ in categories)
+
+    def test_atomic_update(self, control_repo, control_repo_url):
+        for environment in control_repo.environments:
+            environment['stdlib'] = ForgeModule('stdlib', 'puppetlabs',
+                                                Forge('9.9.9'))
+            control_repo.commit_puppetfile(environment, non_interactive=True)
+        control_repo.push_puppetfiles()
+        updated_repo = ControlRepository(clone_url=control_repo_url)
+        for environment in updated_repo.environments:
+            assert str(environment['stdlib']) == 'stdlib:forge:puppetlabs:Forge(9.9.9)'
+        assert str(updated_repo.get_environment('staging')['firewall']) == 'firewall:forge:puppetlabs:Forge(1.10.0)'